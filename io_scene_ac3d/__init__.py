@@ -27,7 +27,7 @@ import datetime
 import bpy
 import mathutils
 from math import radians
-from bpy.props import StringProperty, BoolProperty, FloatProperty, EnumProperty
+from bpy.props import StringProperty, BoolProperty, FloatProperty, EnumProperty, IntProperty
 from bpy_extras.io_utils import ImportHelper, ExportHelper, axis_conversion
 
 bl_info = {
@@ -48,6 +48,14 @@ bl_info = {
 # reload everything
 if "bpy" in locals():
 	import imp
+	if 'reader_ac3d' in locals():
+		imp.reload(reader_ac3d)
+	if 'parse_ac3d' in locals():
+		imp.reload(parse_ac3d)
+	if 'cache_ac3d' in locals():
+		imp.reload(cache_ac3d)
+	if 'image_ac3d' in locals():
+		imp.reload(image_ac3d)
 	if 'import_ac3d' in locals():
 		imp.reload(import_ac3d)
 	if 'export_ac3d' in locals():
@@ -148,6 +156,68 @@ class ImportAC3D(bpy.types.Operator, ImportHelper):
 							description="Show main window with textures applied (transparency works in only in normal direction)",
 							default=False,
 						)
+	use_mmap = BoolProperty(
+							name="Memory-mapped Reader",
+							description="Read the file through a memory map (faster on big files)",
+							default=True,
+						)
+	scan_only = BoolProperty(
+							name="Scan Only",
+							description="Only index the objects of the file and report their counts, don't import anything",
+							default=False,
+						)
+	object_filter = StringProperty(
+							name="Object Filter",
+							description="Comma separated name or path patterns (eg. 'Panel*' or 'Cockpit/*'), only the matching objects and their children are imported",
+							default="",
+						)
+	use_cache = BoolProperty(
+							name="Use Parse Cache",
+							description="Keep the parsed file on disk and reuse it when the same unchanged file is imported again",
+							default=False,
+						)
+	cache_dir = StringProperty(
+							name="Cache Directory",
+							description="Where to keep the parse cache (empty for the system temp directory)",
+							default="",
+							subtype='DIR_PATH',
+						)
+	cache_size = IntProperty(
+							name="Cache Size (MB)",
+							description="Least recently used files are dropped from the cache once it grows past this size",
+							default=1024,
+							min=1,
+						)
+	use_shared_meshes = BoolProperty(
+							name="Share Identical Meshes",
+							description="Objects with the same geometry, materials and texture become linked duplicates of one mesh",
+							default=True,
+						)
+	force_validate = BoolProperty(
+							name="Force Mesh Validation",
+							description="Run blender's mesh validation on every mesh, even though the surfaces are checked and repaired while reading",
+							default=False,
+						)
+	merge_by_material = BoolProperty(
+							name="Merge by Material",
+							description="Join all objects with the same material, texture and texrep into one mesh, the object names are kept as vertex groups",
+							default=False,
+						)
+	texture_paths = StringProperty(
+							name="Texture Search Paths",
+							description="Semicolon separated directories (eg. 'Textures;$FG_ROOT/Textures') searched with their subdirectories for textures that aren't found next to the file",
+							default="",
+						)
+	use_file_identity = BoolProperty(
+							name="Match Images by File Identity",
+							description="Also treat images as the same when their files are the same on disk (device and inode), eg. through links",
+							default=False,
+						)
+	defer_textures = BoolProperty(
+							name="Load Textures Later",
+							description="Import the geometry with placeholder images and load the texture files afterwards, a few at a time (Esc stops loading)",
+							default=False,
+						)
 
 	def execute(self, context):
 		from . import import_ac3d
@@ -163,10 +233,53 @@ class ImportAC3D(bpy.types.Operator, ImportHelper):
 		keywords["global_matrix"] = global_matrix
 
 		t = time.mktime(datetime.datetime.now().timetuple())
-		import_ac3d.ImportAC3D(self, context, **keywords)
+		importer = import_ac3d.ImportAC3D(self, context, **keywords)
 		t = time.mktime(datetime.datetime.now().timetuple()) - t
 		print('Finished importing in', t, 'seconds')
 
+		deferred_images = importer.deferred_images
+		if deferred_images and deferred_images.pending and context.window is None:
+			# no window to run a timer in (background or scripted run), load them now
+			deferred_images.load_slice(float('inf'))
+		elif deferred_images and deferred_images.pending:
+			# load the textures from a timer, so blender stays usable meanwhile
+			self._deferred_images = deferred_images
+			wm = context.window_manager
+			self._timer = wm.event_timer_add(0.1, context.window)
+			wm.modal_handler_add(self)
+			wm.progress_begin(0, len(deferred_images.pending))
+			return {'RUNNING_MODAL'}
+
+		return {'FINISHED'}
+
+	def modal(self, context, event):
+		deferred_images = self._deferred_images
+		if event.type == 'ESC':
+			# what's loaded stays, the rest keep their placeholders
+			self.report({'INFO'}, "Stopped loading textures, {0} of {1} left as placeholders".format(
+					len(deferred_images.pending) - deferred_images.done, len(deferred_images.pending)))
+			return self.end_texture_loading(context)
+
+		if event.type == 'TIMER':
+			finished = deferred_images.load_slice(0.05)
+			context.window_manager.progress_update(deferred_images.done)
+			for area in context.screen.areas:
+				if area.type == 'VIEW_3D':
+					area.tag_redraw()
+			if finished:
+				self.report({'INFO'}, "Loaded {0} textures".format(len(deferred_images.pending)))
+				return self.end_texture_loading(context)
+
+		return {'PASS_THROUGH'}
+
+	def cancel(self, context):
+		# blender dropped the modal handler (file load, window closed)
+		self.end_texture_loading(context)
+
+	def end_texture_loading(self, context):
+		wm = context.window_manager
+		wm.event_timer_remove(self._timer)
+		wm.progress_end()
 		return {'FINISHED'}
 
 class ExportAC3D(bpy.types.Operator, ExportHelper):
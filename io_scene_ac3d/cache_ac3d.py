@@ -0,0 +1,135 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+
+import numpy
+
+'''
+On-disk cache of parsed .ac files, used by the importer.
+
+Every entry is a directory named after its key, holding index.json (the
+materials and the object tree) and one .npy file per array. The arrays are
+memory-mapped when the entry is loaded, so a cache hit costs next to nothing
+until the data is actually used.
+
+The modification time of index.json is bumped on every hit and the least
+recently used entries are removed once the cache grows past its byte budget.
+
+Nothing in here depends on blender.
+'''
+
+# bump this whenever the layout of the cached data changes
+CACHE_VERSION = 2
+
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'blender_ac3d_cache')
+
+class AcCache:
+	'''
+	A directory of cached parse results with a size limit
+	'''
+	def __init__(self, cache_dir, max_bytes):
+		self.cache_dir = cache_dir or DEFAULT_CACHE_DIR
+		self.max_bytes = max_bytes
+
+	'''
+	Builds the key of a file from its path, size, mtime and a hash of its
+	content, plus anything else the parse result depends on (extra)
+	'''
+	def make_key(self, filepath, extra=''):
+		filepath = os.path.abspath(filepath)
+		stat = os.stat(filepath)
+
+		content = hashlib.sha1()
+		with open(filepath, 'rb') as ac_file:
+			for chunk in iter(lambda: ac_file.read(1 << 20), b''):
+				content.update(chunk)
+
+		key = hashlib.sha1()
+		for part in (CACHE_VERSION, filepath, stat.st_size, repr(stat.st_mtime), content.hexdigest(), extra):
+			key.update(str(part).encode('utf-8', 'replace'))
+			key.update(b'\0')
+		return key.hexdigest()
+
+	'''
+	Returns the (meta, arrays) stored for key, or None. The arrays are memory-mapped
+	'''
+	def load(self, key):
+		entry_dir = os.path.join(self.cache_dir, key)
+		index_path = os.path.join(entry_dir, 'index.json')
+		try:
+			with open(index_path, 'r') as index_file:
+				index = json.load(index_file)
+			arrays = {}
+			for name in index['arrays']:
+				arrays[name] = numpy.load(os.path.join(entry_dir, name + '.npy'), mmap_mode='r')
+			# mark as recently used
+			os.utime(index_path, None)
+		except (EnvironmentError, ValueError, KeyError):
+			return None
+		return index['meta'], arrays
+
+	'''
+	Stores meta (anything json can write) and a dictionary of arrays for key
+	'''
+	def store(self, key, meta, arrays):
+		entry_dir = os.path.join(self.cache_dir, key)
+		if os.path.isdir(entry_dir):
+			return
+
+		# write into a private directory first so a half written entry is never used
+		temp_dir = entry_dir + '.tmp{0}'.format(os.getpid())
+		try:
+			os.makedirs(temp_dir)
+			for name, array in arrays.items():
+				numpy.save(os.path.join(temp_dir, name + '.npy'), numpy.ascontiguousarray(array))
+			with open(os.path.join(temp_dir, 'index.json'), 'w') as index_file:
+				json.dump({'arrays': sorted(arrays.keys()), 'meta': meta}, index_file)
+			os.rename(temp_dir, entry_dir)
+		except EnvironmentError:
+			shutil.rmtree(temp_dir, True)
+			return
+
+		self.evict()
+
+	'''
+	Removes the least recently used entries until the cache fits its byte budget
+	'''
+	def evict(self):
+		entries = []
+		total = 0
+		for name in os.listdir(self.cache_dir):
+			entry_dir = os.path.join(self.cache_dir, name)
+			index_path = os.path.join(entry_dir, 'index.json')
+			if not os.path.isfile(index_path):
+				continue
+			size = sum(os.path.getsize(os.path.join(entry_dir, f)) for f in os.listdir(entry_dir))
+			entries.append((os.path.getmtime(index_path), size, entry_dir))
+			total += size
+
+		entries.sort()
+		for last_used, size, entry_dir in entries:
+			if total <= self.max_bytes:
+				break
+			shutil.rmtree(entry_dir, True)
+			total -= size
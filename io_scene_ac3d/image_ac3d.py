@@ -0,0 +1,102 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+
+import os
+import struct
+
+'''
+Finds out whether texture files have an alpha channel by reading their
+headers only, so the importer can leave transparency off for opaque textures
+without loading them.
+
+PNG, SGI (.rgb, .rgba, .sgi) and JPEG files are understood, for anything else
+the answer is None (unknown). Results are kept for the whole blender session,
+by path and modification time.
+
+Nothing in here depends on blender.
+'''
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+SGI_MAGIC = 474
+JPEG_SIGNATURE = b'\xff\xd8'
+
+# (absolute path, mtime) -> True, False or None
+alpha_cache = {}
+
+'''
+Returns True if the image file at path has an alpha channel (or transparency),
+False if it hasn't and None if that can't be told from its header
+'''
+def has_alpha(path):
+	path = os.path.abspath(path)
+	try:
+		key = (path, os.path.getmtime(path))
+	except EnvironmentError:
+		return None
+	if key not in alpha_cache:
+		try:
+			with open(path, 'rb') as image_file:
+				alpha_cache[key] = read_alpha(image_file)
+		except (EnvironmentError, struct.error, ValueError, TypeError):
+			# unreadable or malformed header, don't let it stop the import
+			alpha_cache[key] = None
+	return alpha_cache[key]
+
+def read_alpha(image_file):
+	header = image_file.read(12)
+	if header[:8] == PNG_SIGNATURE:
+		image_file.seek(8)
+		return read_png_alpha(image_file)
+	if len(header) >= 12 and struct.unpack('>H', header[:2])[0] == SGI_MAGIC:
+		# ZSIZE is the number of channels, 2 is grey with alpha and 4 is RGBA
+		return struct.unpack('>H', header[10:12])[0] in (2, 4)
+	if header[:2] == JPEG_SIGNATURE:
+		return False
+	return None
+
+'''
+Goes through the chunks up to the image data: colour types 4 (grey with alpha)
+and 6 (RGBA) have an alpha channel, any other type is transparent if it has a
+tRNS chunk
+'''
+def read_png_alpha(image_file):
+	color_type = None
+	while True:
+		chunk = image_file.read(8)
+		if len(chunk) < 8:
+			return None
+		length, chunk_type = struct.unpack('>I4s', chunk)
+		if chunk_type == b'IHDR':
+			data = image_file.read(length)
+			if len(data) < 10:
+				# truncated header
+				return None
+			color_type = ord(data[9:10])
+			if color_type in (4, 6):
+				return True
+			image_file.seek(4, 1)
+		elif chunk_type == b'tRNS':
+			return True
+		elif chunk_type in (b'IDAT', b'IEND'):
+			if color_type is None:
+				# no IHDR, not a proper PNG
+				return None
+			return False
+		else:
+			image_file.seek(length + 4, 1)
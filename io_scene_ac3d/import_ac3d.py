@@ -18,10 +18,13 @@
 
 
 import os
+import time
 import struct
+import hashlib
+from fnmatch import fnmatchcase
 
 import bpy
-import csv
+import numpy
 import mathutils
 from mathutils import Vector, Euler
 from math import radians
@@ -30,6 +33,12 @@ from bpy_extras.image_utils import load_image
 from bpy_extras.io_utils import unpack_list, unpack_face_list
 from bpy_extras.mesh_utils import ngon_tessellate
 
+from .reader_ac3d import AcFileReader, AcMmapReader, AcParseError
+from .parse_ac3d import parse_events, repair_surfaces, MATERIAL, BEGIN_OBJECT, PROPERTY, VERTICES, SURFACES, END_OBJECT, INVALID_TOKEN
+from .parse_ac3d import SURF_TYPE_MASK, SURF_SHADED, SURF_TWOSIDED
+from .cache_ac3d import AcCache
+from .image_ac3d import has_alpha
+
 '''
 This file is a reboot of the AC3D import script that is used to import .ac format file into blender.
 
@@ -109,54 +118,112 @@ class AcMat:
 		if tex_name == '':
 			bl_mat = self.bl_material
 			if bl_mat == None:
-				bl_mat = bpy.data.materials.new(self.name)
-				bl_mat = self.make_blender_mat(bl_mat)
+				registry_key = self.get_registry_key()
+				bl_mat = self.import_config.get_material_registry().get(registry_key)
+				if bl_mat == None:
+					bl_mat = bpy.data.materials.new(self.name)
+					bl_mat = self.make_blender_mat(bl_mat)
+					self.register_material(bl_mat, registry_key)
 
 				self.bl_material = bl_mat
 		else:
-			if (tex_name+str(texrep[0])+'-'+str(texrep[1])) in self.bmat_keys:
-				bl_mat = self.bmat_keys[tex_name+str(texrep[0])+'-'+str(texrep[1])]
+			bmat_key = tex_name+str(texrep[0])+'-'+str(texrep[1])
+			if bmat_key in self.bmat_keys:
+				bl_mat = self.bmat_keys[bmat_key]
 			else:
+				# an equal material made by this or an earlier import will do
+				registry_key = self.get_registry_key(tex_name, texrep)
+				bl_mat = self.import_config.get_material_registry().get(registry_key)
+				if bl_mat != None:
+					self.bmat_keys[bmat_key] = bl_mat
+					return bl_mat
+
 				bl_mat = bpy.data.materials.new(self.name)
 				bl_mat = self.make_blender_mat(bl_mat)
+				# alpha blending is only worth its cost if the texture has
+				# alpha, unknown formats keep it on to be safe
+				use_alpha = self.get_texture_alpha(tex_name) != False
 				bl_mat.use_face_texture = True
-				bl_mat.use_face_texture_alpha = True
+				bl_mat.use_face_texture_alpha = use_alpha
 				
 				tex_slot = bl_mat.texture_slots.add()
 				tex_slot.texture = self.get_blender_texture(tex_name, texrep)
 				tex_slot.texture_coords = 'UV'
 				tex_slot.alpha_factor = 1.0
-				tex_slot.use_map_alpha = True
+				tex_slot.use_map_alpha = use_alpha
 				tex_slot.use = True
 				tex_slot.uv_layer = 'UVMap'
 				tex_slot.texture.repeat_x = texrep[0]
 				tex_slot.texture.repeat_y = texrep[1]
-				self.bmat_keys[tex_name+str(texrep[0])+'-'+str(texrep[1])] = bl_mat
+				self.register_material(bl_mat, registry_key)
+				self.bmat_keys[bmat_key] = bl_mat
 		return bl_mat
 
+	'''
+	Key of the blender material made from this one with the texture (found by
+	its file, not its name), the texrep and the import settings. The colours
+	are rounded, so values that only differ by float noise get the same key
+	'''
+	def get_registry_key(self, tex_name='', texrep=(1, 1)):
+		def quantize(values):
+			return tuple(int(round(value * 1000)) for value in values)
+
+		tex_path = ''
+		tex_alpha = None
+		if tex_name != '':
+			tex_path = self.import_config.texture_finder.find(tex_name) or tex_name
+			tex_alpha = self.get_texture_alpha(tex_name)
+		config = self.import_config
+		key = (quantize(self.rgb), quantize(self.amb), quantize(self.emis), quantize(self.spec),
+				quantize([self.shi, self.trans]), tex_path, tex_alpha, tuple(texrep),
+				config.use_transparency, config.transparency_method, config.use_emis_as_mircol, config.use_amb_as_mircol)
+		return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+	'''
+	Whether the texture file of tex_name has an alpha channel, None if it
+	isn't found or its format isn't known. Only the header of the file is
+	read, and only once per blender session unless the file changes
+	'''
+	def get_texture_alpha(self, tex_name):
+		path = self.import_config.texture_finder.find(tex_name)
+		if path:
+			return has_alpha(path)
+		return None
+
+	'''
+	Marks bl_mat with its key, so later imports in this blender session (or
+	from this .blend file) can use it again
+	'''
+	def register_material(self, bl_mat, registry_key):
+		bl_mat['ac3d_key'] = registry_key
+		# to tell later on whether the material has been edited since
+		bl_mat['ac3d_state'] = self.import_config.get_material_state(bl_mat)
+		self.import_config.get_material_registry()[registry_key] = bl_mat
+
 	'''
 	looks for the image in blender, adds it if it doesn't exist, returns the image to the callee
 	'''
 	def get_blender_image(self, tex_name):
 		bl_image = None
-		if tex_name in bpy.data.images:
+		path = self.import_config.texture_finder.find(tex_name)
+		if path:
+			# the same file may be named differently, so images are matched by file
+			bl_image = self.import_config.find_image(path)
+			if bl_image == None and self.import_config.deferred_images:
+				# a placeholder for now, the file is loaded once the geometry is in
+				bl_image = self.import_config.deferred_images.add(path)
+				self.import_config.register_image(bl_image, path)
+			elif bl_image == None:
+				try:
+					bl_image = bpy.data.images.load(path)
+					self.import_config.register_image(bl_image, path)
+				except:
+					TRACE("Failed to load texture: {0}".format(tex_name))
+		elif tex_name in bpy.data.images:
+			# not on disk, but maybe packed or made in blender
 			bl_image = bpy.data.images[tex_name]
 		else:
-			found = False
-			base_name = bpy.path.basename(tex_name)
-			for path in [ tex_name,
-										os.path.join(self.import_config.importdir, tex_name),
-										os.path.join(self.import_config.importdir, base_name) ]:
-				if os.path.exists(path):
-					found = True
-
-					try:
-						bl_image = bpy.data.images.load(path)
-					except:
-						TRACE("Failed to load texture: {0}".format(tex_name))
-			
-			if not found:
-				TRACE("Failed to locate texture: {0}".format(tex_name))
+			TRACE("Failed to locate texture: {0}".format(tex_name))
 
 		return bl_image
 
@@ -164,13 +231,17 @@ class AcMat:
 	looks for the blender texture, adds it if it doesn't exist
 	'''
 	def get_blender_texture(self, tex_name, texrep):
-		bl_tex = None
-		if tex_name in bpy.data.textures and bpy.data.textures[tex_name].repeat_x == texrep[0] and bpy.data.textures[tex_name].repeat_y == texrep[1]:
-			bl_tex = bpy.data.textures[tex_name]
-		else:
+		# textures are matched by their image, which stands for the file, so
+		# two files of the same name never share one and two names of one file do
+		bl_image = self.get_blender_image(tex_name)
+		texture_registry = self.import_config.get_texture_registry()
+		tex_key = self.import_config.get_texture_key(bl_image, tex_name, texrep)
+		bl_tex = texture_registry.get(tex_key)
+		if bl_tex == None:
 			bl_tex = bpy.data.textures.new(tex_name, 'IMAGE')
-			bl_tex.image = self.get_blender_image(tex_name)
+			bl_tex.image = bl_image
 			bl_tex.use_preview_alpha = True
+			texture_registry[tex_key] = bl_tex
 			
 		return bl_tex
 
@@ -178,7 +249,12 @@ class AcObj:
 	'''
 	Container class for a .ac OBJECT
 	'''
-	def __init__(self, ob_type, ac_file, import_config, parent = None):
+	# scalar properties and arrays kept in the parse cache
+	CACHED_PROPS = ('name', 'data', 'tex_name', 'texrep', 'texoff', 'url', 'crease', 'subdiv',
+					'offset', 'num_vert', 'num_surf', 'num_kids', 'vert_range', 'surf_range')
+	CACHED_ARRAYS = ('vertices', 'surf_offsets', 'surf_refs', 'surf_uvs', 'surf_flags', 'surf_mats')
+
+	def __init__(self, ob_type, import_config, parent = None, offset = 0):
 		self.type = ob_type			# Type of object
 		self.ac_parent = parent		# reference to the parent object (if the object is World, then this should be None)
 		self.name = ''				# name of the object
@@ -190,88 +266,171 @@ class AcObj:
 		self.rotation = mathutils.Matrix(([1,0,0],[0,1,0],[0,0,1]))	# 3x3 rotational matrix for vertices
 		self.url = ''				# url of the object (??!)
 		self.crease = 61			# crease angle for smoothing
-		self.vert_list = []				# list of Vector(X,Y,Z) objects
-		self.surf_list = []			# list of attached surfaces
-		self.face_list = []			# flattened surface list
-		self.surf_face_list = []    # list of surfs that is faces, no edges
-		self.edge_list = []			# spare edge list (handles poly lines etc)
-		self.face_mat_list = []		# flattened surface material index list
+		self.subdiv = 0				# subdivision level
+		self.vertices = numpy.zeros((0, 3))	# (N,3) array of vertex co-ordinates
+		# surfaces are stored in a CSR like layout: the refs of surface n are
+		# surf_refs[surf_offsets[n]:surf_offsets[n+1]], with one UV per ref
+		self.surf_offsets = numpy.zeros(1, dtype=numpy.int32)	# start of each surface in surf_refs
+		self.surf_refs = numpy.zeros(0, dtype=numpy.int32)		# flat vertex indices of all surfaces
+		self.surf_uvs = numpy.zeros((0, 2), dtype=numpy.float32)	# flat UV co-ordinates of all surfaces
+		self.surf_flags = numpy.zeros(0, dtype=numpy.uint8)		# SURF flags of each surface
+		self.surf_mats = numpy.zeros(0, dtype=numpy.int32)		# material index of each surface
+		self.surf_face_list = numpy.zeros(0, dtype=numpy.int32)	# index of the surface of each face, no edges
+		self.edge_list = numpy.zeros((0, 2), dtype=numpy.int32)	# (N,2) spare edges (handles poly lines etc)
+		self.face_mat_list = numpy.zeros(0, dtype=numpy.int32)	# mesh material slot of each face
 		self.children = []			
-		self.bl_mat_dict = {}		# Dictionary of ac_material index/texture pair to blender mesh material index
 
+		# structure of the object in the file
+		self.offset = offset		# byte offset of the OBJECT line
+		self.num_vert = 0			# numvert count
+		self.num_surf = 0			# numsurf count
+		self.num_kids = 0			# kids count
+		self.vert_range = None		# (start, end) byte offsets of the numvert block
+		self.surf_range = None		# (start, end) byte offsets of the numsurf block
+		self.path = None			# slash separated names of the object and its parents (worked out on first use)
+		self.selected = None		# picked by the import filter (worked out on first use)
+		self.bl_mat_dict = {}		# Dictionary of blender material name to blender mesh material index
+		self.vertex_group_list = []	# (name, first vertex, vertex count) of the objects merged into this one
+
+		self.bl_name = None			# unique name of the blender object (worked out before anything is created)
 		self.bl_obj = None			# Blender object
 		self.import_config = import_config
 
-		self.tokens =	{
-						'numvert':	self.read_vertices,
-						'numsurf':	self.read_surfaces,
-						'name':		self.read_name,
-						'data':		self.read_data,
-						'kids':		self.read_children,
-						'loc':		self.read_location,
-						'rot':		self.read_rotation,
-						'texture':	self.read_texture,
-						'texrep':	self.read_texrep,
-						'texoff':	self.read_texoff,
-						'subdiv':	self.read_subdiv,
-						'crease':	self.read_crease
-						}
-
-		self.read_ac_object(ac_file)
-
-	'''
-	Read the object lines and dump them into this object, making hierarchial attachments to parents
-	'''
-	def read_ac_object(self, ac_file):
-		bDone = False
-		while not bDone:
-			line = ac_file.readline()
-			if line == '':
-				break
-			toks = line.strip().split()
-			if len(toks)>0:
-				if toks[0] in self.tokens.keys():
-					bDone = self.tokens[toks[0]](ac_file,toks)
-				else:
-					bDone = True
-
-	def read_vertices(self, ac_file, toks):
-		vertex_count = int(toks[1])
-		for n in range(vertex_count):
-			line = ac_file.readline()
-			line = line.strip().split()
-			self.vert_list.append(self.import_config.global_matrix * Vector([float(x) for x in line]))
-
-	def read_surfaces(self, ac_file, toks):
-		surf_count = int(toks[1])
-
-		for n in range(surf_count):
-			line = ac_file.readline()
-			if line=='':
-				break
+	'''
+	Returns the properties of the object for the parse cache
+	'''
+	def get_cache_meta(self):
+		meta = dict((prop, getattr(self, prop)) for prop in self.CACHED_PROPS)
+		meta['type'] = self.type
+		meta['location'] = list(self.location)
+		meta['rotation'] = [list(row) for row in self.rotation]
+		return meta
 
-			line = line.strip().split()
-			if line[0] == 'SURF':
-				surf = AcSurf(line[1], ac_file, self.import_config)
-				if( surf.flags.type != 0 or len(surf.refs) > 2):
-					self.surf_list.append(surf)
-				else:
-					TRACE("Ignoring surface (vertex-count: {0})".format(len(surf.refs)))					
+	'''
+	Restores the properties stored by get_cache_meta
+	'''
+	def set_cache_meta(self, meta):
+		for prop in self.CACHED_PROPS:
+			setattr(self, prop, meta[prop])
+		if self.vert_range:
+			self.vert_range = tuple(self.vert_range)
+		if self.surf_range:
+			self.surf_range = tuple(self.surf_range)
+		self.location = Vector(meta['location'])
+		self.rotation = mathutils.Matrix(meta['rotation'])
 
-	def read_name(self, ac_file, toks):
-		self.name=toks[1].strip('"')
-		return False
+	'''
+	Returns the objects from the top-most parent that hasn't got attr set yet
+	down to this one, so they can be worked out top down without recursing
+	'''
+	def get_unset_parents(self, attr):
+		objs = []
+		obj = self
+		while obj and getattr(obj, attr) is None:
+			objs.append(obj)
+			obj = obj.ac_parent
+		objs.reverse()
+		return objs
 
-	def read_data(self, ac_file, toks):
-		line = ac_file.readline()
-		self.data=line[:int(toks[1])]
-		return False
+	'''
+	The slash separated names of the object and its parents (the world isn't named)
+	'''
+	def get_path(self):
+		for obj in self.get_unset_parents('path'):
+			parent_path = ''
+			if obj.ac_parent:
+				parent_path = obj.ac_parent.path
+			if obj.type == 'world':
+				obj.path = parent_path
+			elif parent_path:
+				obj.path = parent_path + '/' + obj.name
+			else:
+				obj.path = obj.name
+		return self.path
 
-	def read_location(self, ac_file, toks):
-		self.location=(self.import_config.global_matrix * Vector([float(x) for x in toks[1:4]]))
-		return False
+	'''
+	Whether the object is part of the subtrees picked by the import filter
+	'''
+	def is_selected(self):
+		patterns = self.import_config.object_filter
+		for obj in self.get_unset_parents('selected'):
+			if not patterns or (obj.ac_parent and obj.ac_parent.selected):
+				obj.selected = True
+			else:
+				path = obj.get_path()
+				obj.selected = any(fnmatchcase(obj.name, pattern) or fnmatchcase(path, pattern) for pattern in patterns)
+		return self.selected
 
-	def read_rotation(self, ac_file, toks):
+	'''
+	Whether numvert/numsurf need decoding, they're skipped otherwise
+	'''
+	def load_geometry(self):
+		return not self.import_config.scan_only and self.is_selected()
+
+	'''
+	The combined transform of the parents left out by the import filter
+	'''
+	def get_filtered_parent_matrix(self):
+		matrix = mathutils.Matrix()
+		parent = self.ac_parent
+		while parent and parent.type != 'world':
+			matrix = mathutils.Matrix.Translation(parent.location) * parent.rotation.to_4x4() * matrix
+			parent = parent.ac_parent
+		return matrix
+
+	'''
+	Read the numvert block, or skip it if the object's geometry isn't wanted
+	'''
+	def read_vertices(self, block):
+		self.num_vert = block.count
+		if not self.load_geometry():
+			block.skip()
+			self.vert_range = (block.start, block.end)
+			return
+		verts = block.read()
+		self.vert_range = (block.start, block.end)
+		# any extra columns (eg. vertex normals) are ignored
+		self.vertices = self.import_config.transform_vertices(verts[:, :3])
+
+	'''
+	Read the numsurf block into the flat surface arrays, or skip it if the
+	object's geometry isn't wanted
+	'''
+	def read_surfaces(self, block):
+		self.num_surf = block.count
+		if not self.load_geometry():
+			block.skip()
+			self.surf_range = (block.start, block.end)
+			return
+		flags, mats, counts, refs = block.read()
+		self.surf_range = (block.start, block.end)
+
+		# anything blender's validation would have to fix is fixed here
+		flags, mats, counts, refs, problems = repair_surfaces(len(self.vertices), flags, mats, counts, refs)
+		for problem, count in problems.items():
+			TRACE("{0}: repaired {1} {2}".format(self.name, count, problem))
+			repairs = self.import_config.repairs
+			repairs[problem] = repairs.get(problem, 0) + count
+
+		self.surf_offsets = numpy.zeros(len(counts) + 1, dtype=numpy.int32)
+		numpy.cumsum(counts, out=self.surf_offsets[1:])
+		self.surf_refs = refs[:, 0].astype(numpy.int32)
+		self.surf_uvs = refs[:, 1:3].astype(numpy.float32)
+		self.surf_flags = flags
+		self.surf_mats = mats
+
+	def read_name(self, toks):
+		self.name=toks[1]
+
+	def read_data(self, toks):
+		# the parser has read the data string already
+		self.data=toks[1]
+
+	def read_location(self, toks):
+		loc = numpy.array([[float(x) for x in toks[1:4]]])
+		self.location = Vector(self.import_config.transform_vertices(loc)[0])
+
+	def read_rotation(self, toks):
 		self.rotation = mathutils.Matrix(([float(x) for x in toks[1:4]], [float(x) for x in toks[4:7]], [float(x) for x in toks[7:10]]))
 #		TODO check
 #		rotation = mathutils.Matrix(( [float(x) for x in toks[1:4]],
@@ -279,264 +438,447 @@ class AcObj:
 #		                              [float(x) for x in toks[7:10]] )).to_quaternion()
 #		rotation.axis = self.import_config.global_matrix * rotation.axis
 #		self.rotation = rotation.to_matrix()
-		return False
 
-	def read_texture(self, ac_file, toks):
-		self.tex_name=toks[1].strip('"')
-		return False
+	def read_texture(self, toks):
+		self.tex_name=toks[1]
 
-	def read_texrep(self, ac_file, toks):
+	def read_texrep(self, toks):
 		self.texrep[0]=int(float(toks[1]))
 		self.texrep[1]=int(float(toks[2]))
-		return False
 
-	def read_texoff(self, ac_file, toks):
+	def read_texoff(self, toks):
 		self.texoff=toks[1:2]
-		return False
 
-	def read_subdiv(self, ac_file, toks):
+	def read_subdiv(self, toks):
 		self.subdiv=int(toks[1])
-		return False
 
-	def read_crease(self, ac_file, toks):
+	def read_crease(self, toks):
 		self.crease=float(toks[1])
-		return False
 
-	def read_children(self, ac_file, toks):
-		num_kids = int(toks[1])
-		for n in range(num_kids):
-			line = ac_file.readline()
-			if line == '':
-				break			
-			line = line.strip().split()
-			self.children.append(AcObj(line[1].strip('"'), ac_file, self.import_config, self))
-		# This is assumed to be the last thing in the list of things to read
-		# returning True indicates to cease parsing this object
-		return True
+	def read_url(self, toks):
+		self.url=toks[1]
+
+	def read_children(self, toks):
+		# the kids themselves are handed out by the parser
+		self.num_kids = int(toks[1])
+
+	# the object line handlers by their first token, other lines are ignored
+	tokens = 	{
+				'name':		read_name,
+				'data':		read_data,
+				'kids':		read_children,
+				'loc':		read_location,
+				'rot':		read_rotation,
+				'texture':	read_texture,
+				'texrep':	read_texrep,
+				'texoff':	read_texoff,
+				'subdiv':	read_subdiv,
+				'crease':	read_crease,
+				'url':		read_url,
+				}
 	
 
 	'''
 	This function does the work of creating an object in blender and configuring it correctly
 	'''
-	def create_blender_object(self, ac_matlist, str_pre, bLevelLinked):
+	def create_blender_object(self, ac_matlist, str_pre):
 
 		if self.type == 'world':
 			self.name = self.import_config.ac_name
 			self.rotation = self.import_config.global_matrix
 		me = None
-		if self.type == 'group':
+		selected = self.is_selected()
+		if self.type == 'group' and selected:
 			# Create an empty object
-			self.bl_obj = bpy.data.objects.new(self.name, None)
-
-		if self.type == 'poly':
-			meshname = self.name+".mesh"
-			if len(self.data)>0:
-				meshname = self.data
-			me = bpy.data.meshes.new(meshname)
-			self.bl_obj = bpy.data.objects.new(self.name, me)
+			self.bl_obj = bpy.data.objects.new(self.bl_name, None)
+
+		shared_mesh = False
+		if self.type == 'poly' and selected:
+			mesh_key = None
+			if self.import_config.use_shared_meshes:
+				# objects with the same content become linked duplicates of one mesh
+				mesh_key = self.get_mesh_key()
+				me = self.import_config.shared_meshes.get(mesh_key)
+				shared_mesh = me is not None
+			if not shared_mesh:
+				meshname = self.name+".mesh"
+				if len(self.data)>0:
+					meshname = self.data
+				me = bpy.data.meshes.new(self.import_config.mesh_names.get(meshname))
+				if mesh_key:
+					self.import_config.shared_meshes[mesh_key] = me
+			self.bl_obj = bpy.data.objects.new(self.bl_name, me)
 
 		# setup parent object
-		if self.ac_parent:
+		if self.ac_parent and self.bl_obj:
 			self.bl_obj.parent = self.ac_parent.bl_obj
 
 		# make sure we have something to work with
-		if self.vert_list and me:
-
-			me.use_auto_smooth = self.import_config.use_auto_smooth
-			me.auto_smooth_angle = radians(self.crease)
-			two_sided_lighting = False
-			has_uv = False
-			for surf in self.surf_list:
-				surf_edges = surf.get_edges()
-				surf_face = surf.get_faces()
-
-				for line in surf_edges:
-					self.edge_list.append(line)
-
-				if surf.flags.type == 0:
-					# test for invalid face (ie, >4 vertices)
-					if len(surf.refs) < 3:
-						# not bringing in faces (assumed that there are none in a poly-line)
-						TRACE("Ignoring surface (vertex-count: {0})".format(len(surf.refs)))
-					else:
-						# If one surface is twosided, they all will be...
-						two_sided_lighting |= surf.flags.two_sided
-
-						has_uv |= len(surf.uv_refs) > 0
-
-						self.face_list.append(surf_face)
-						self.surf_face_list.append(surf)
-						
-						# Material index is 1 based, the list we built is 0 based
-						ac_material = ac_matlist[surf.mat_index]
-						bl_material = ac_material.get_blender_material(self.texrep, self.tex_name)
-
-						if bl_material == None:
-							TRACE("Error getting material {0} '{1}'".format(surf.mat_index, self.tex_name))
-
-						fm_index = 0
-						if not bl_material.name in me.materials:
-							me.materials.append(bl_material)
-							fm_index = len(me.materials)-1
-						else:
-							for mat in me.materials:
-								if mat == bl_material:
-									continue
-								fm_index += 1
-							if fm_index > len(me.materials):
-								TRACE("Failed to find material index")
-								fm_index = 0
-						self.face_mat_list.append(fm_index)
-				else:
-					# treating as a polyline (nothing more to do)
-					pass
-
-			me.from_pydata(self.vert_list, self.edge_list, self.face_list);
-
-			y=0	
-			for no, poly in enumerate(me.polygons):
-				if self.surf_face_list[no].flags.shaded == True:
-					poly.use_smooth = True
-				else:
-					poly.use_smooth = False
-				y= y+1			
-
-			
-			if has_uv:
-				uvtex = me.uv_textures.new()
-				if uvtex:
-					uvtexdata = me.uv_layers.active.data[:]
-					
-					uv_pointer = 0
-					for i, face in enumerate(self.face_list):
-						surf = self.surf_face_list[i]
-						
-						if len(surf.uv_refs) >= 3:
-
-							for vert_index in range(len(surf.uv_refs)):
-								uvtexdata[uv_pointer+vert_index].uv = surf.uv_refs[vert_index]
-							if len(self.tex_name):
-								# we do the check here to allow for import of UV without texture
-								surf_material = me.materials[self.face_mat_list[i]]
-								uvtex.data[i].image = surf_material.texture_slots[0].texture.image
-							uv_pointer += len(surf.uv_refs)
-			
-			me.show_double_sided = two_sided_lighting
+		if len(self.vertices) and me:
+			if not shared_mesh:
+				self.fill_mesh(me, ac_matlist)
 			self.bl_obj.show_transparent = self.import_config.display_transparency
 
+			# keep track of where the vertices of merged objects came from
+			vertex_groups = {}
+			for name, first, count in self.vertex_group_list:
+				if name not in vertex_groups:
+					vertex_groups[name] = self.bl_obj.vertex_groups.new(name)
+				vertex_groups[name].add(list(range(first, first + count)), 1.0, 'REPLACE')
+
 		if self.bl_obj:
+			# blender's name may have a suffix, the original one is kept with the object
+			self.bl_obj['ac3d_name'] = self.name
 			self.bl_obj.rotation_euler = self.rotation.to_euler()
 
 			self.bl_obj.location = self.location
+
+			if self.ac_parent and not self.ac_parent.is_selected():
+				# the parents weren't imported, keep the object where they'd have put it
+				matrix = self.get_filtered_parent_matrix() * self.bl_obj.matrix_basis
+				self.bl_obj.rotation_euler = matrix.to_euler()
+				self.bl_obj.location = matrix.to_translation()
 			
-			self.import_config.context.scene.objects.link(self.bl_obj)
-# There's a bug somewhere - this ought to work....
-			self.import_config.context.scene.objects.active = self.bl_obj
+			# linked to the scene once the whole file has been created
+			self.import_config.new_objects.append(self.bl_obj)
 #			bpy.ops.object.origin_set('ORIGIN_GEOMETRY', 'MEDIAN')
 			
 
 		TRACE("{0}+-{1} ({2})".format(str_pre, self.name, self.data))
 
-		# Add any children
-		str_pre_new = ""
-		bUseLink = True
-		for obj in self.children:
-			if bLevelLinked:
-				str_pre_new = str_pre + "| "
-			else:
-				str_pre_new = str_pre + "  "
+		if me and not shared_mesh:
+#			me.calc_normals()
+			# the surfaces were repaired when they were read, so blender's
+			# own check is only needed when asked for
+			if self.import_config.force_validate:
+				me.validate()
+			me.update(calc_edges=True)
+
+	'''
+	Hash of everything the mesh of the object is built from, objects with the
+	same key can share one mesh
+	'''
+	def get_mesh_key(self):
+		key = hashlib.sha1()
+		for name in self.CACHED_ARRAYS:
+			array = numpy.ascontiguousarray(getattr(self, name))
+			# the shape keeps the arrays apart
+			key.update(repr(array.shape).encode('utf-8'))
+			key.update(array)
+		key.update(repr((self.tex_name, self.texrep, self.crease)).encode('utf-8'))
+		return key.hexdigest()
 
-			if self.children.index(obj) == len(self.children)-1:
-				bUseLink = False
+	'''
+	Fills a new mesh with the geometry, materials and UVs of the object
+	'''
+	def fill_mesh(self, me, ac_matlist):
+		me.use_auto_smooth = self.import_config.use_auto_smooth
+		me.auto_smooth_angle = radians(self.crease)
+		surf_types = self.surf_flags & SURF_TYPE_MASK
+		surf_counts = numpy.diff(self.surf_offsets)
+
+		# the polygons are the surfaces of type 0, their refs are the loops of the mesh
+		is_face = surf_types == 0
+		self.surf_face_list = numpy.flatnonzero(is_face)
+		is_loop = numpy.repeat(is_face, surf_counts)
+		loop_verts = self.surf_refs[is_loop]
+		loop_totals = surf_counts[is_face]
+		loop_starts = numpy.cumsum(loop_totals) - loop_totals
+
+		# If one surface is twosided, they all will be...
+		two_sided_lighting = bool((self.surf_flags[is_face] & SURF_TWOSIDED).any())
+		# every ref carries its UV co-ordinates
+		has_uv = len(self.surf_face_list) > 0
+
+		# poly-lines: blender edges join two vertices, so every ref of a line
+		# starts an edge to the ref after it. The last ref of a closed line
+		# goes back to the first one, the last ref of an open line starts nothing
+		is_line = ~is_face
+		line_counts = surf_counts[is_line]
+		line_refs = self.surf_refs[numpy.repeat(is_line, surf_counts)]
+		line_starts = numpy.cumsum(line_counts) - line_counts
+		line_lasts = line_starts + line_counts - 1
+		following = numpy.arange(1, len(line_refs) + 1)
+		following[line_lasts] = line_starts
+		starts_edge = numpy.ones(len(line_refs), dtype=bool)
+		# a closed line of two refs would only double its one edge
+		is_closed = (surf_types[is_line] == 1) & (line_counts > 2)
+		starts_edge[line_lasts[~is_closed]] = False
+		self.edge_list = numpy.column_stack((line_refs[starts_edge], line_refs[following[starts_edge]]))
+
+		# resolve the mesh material slot of each distinct material the faces
+		# use (in the order they first appear), then map all faces through
+		# that table at once
+		face_mats = self.surf_mats[self.surf_face_list]
+		used_mats, first_face, face_used = numpy.unique(face_mats, return_index=True, return_inverse=True)
+		used_slots = numpy.zeros(len(used_mats), dtype=numpy.int32)
+		for used in numpy.argsort(first_face):
+			# Material index is 1 based, the list we built is 0 based
+			mat_index = used_mats[used]
+			ac_material = ac_matlist[mat_index]
+			bl_material = ac_material.get_blender_material(self.texrep, self.tex_name)
+
+			if bl_material == None:
+				TRACE("Error getting material {0} '{1}'".format(mat_index, self.tex_name))
+
+			if not bl_material.name in self.bl_mat_dict:
+				me.materials.append(bl_material)
+				self.bl_mat_dict[bl_material.name] = len(me.materials)-1
+			used_slots[used] = self.bl_mat_dict[bl_material.name]
+		self.face_mat_list = used_slots[face_used]
+
+		# fill the mesh straight from flat arrays. The dtypes match the raw
+		# types of the blender properties (float, unsigned int for indices,
+		# unsigned short for material_index and int for the flags) so
+		# foreach_set takes them as buffers instead of item by item
+		me.vertices.add(len(self.vertices))
+		me.vertices.foreach_set('co', numpy.ascontiguousarray(self.vertices, dtype=numpy.float32).ravel())
+		me.edges.add(len(self.edge_list))
+		me.edges.foreach_set('vertices', numpy.ascontiguousarray(self.edge_list, dtype=numpy.uintc).ravel())
+		me.loops.add(len(loop_verts))
+		me.loops.foreach_set('vertex_index', numpy.ascontiguousarray(loop_verts, dtype=numpy.uintc))
+		me.polygons.add(len(loop_totals))
+		me.polygons.foreach_set('loop_start', loop_starts.astype(numpy.uintc))
+		me.polygons.foreach_set('loop_total', loop_totals.astype(numpy.uintc))
+
+		# per polygon attributes, straight from the surface columns
+		face_flags = self.surf_flags[self.surf_face_list]
+		me.polygons.foreach_set('use_smooth', ((face_flags & SURF_SHADED) != 0).astype(numpy.intc))
+		me.polygons.foreach_set('material_index', self.face_mat_list.astype(numpy.ushort))
+		
+		if has_uv:
+			uvtex = me.uv_textures.new()
+			if uvtex:
+				# the loops are in the same order as the refs of the faces
+				loop_uvs = self.surf_uvs[is_loop]
+				me.uv_layers.active.data.foreach_set('uv', numpy.ascontiguousarray(loop_uvs, dtype=numpy.float32).ravel())
+
+				if len(self.tex_name):
+					# we do the check here to allow for import of UV without texture
+					# the image can't go through foreach_set, so look it up once
+					# per material slot. The face images are what the textured
+					# solid and Texture shading views and the UV/Image editor draw,
+					# so every face gets one
+					slot_images = [mat.texture_slots[0].texture.image for mat in me.materials]
+					if any(image is not None for image in slot_images):
+						if all(image == slot_images[0] for image in slot_images):
+							image = slot_images[0]
+							for face in uvtex.data:
+								face.image = image
+						else:
+							for face, slot in zip(uvtex.data, self.face_mat_list):
+								face.image = slot_images[slot]
+		
+		me.show_double_sided = two_sided_lighting
 
-			obj.create_blender_object(ac_matlist, str_pre_new, bUseLink)
 
+class AcNames:
+	'''
+	Hands out names that aren't used in a blender ID collection yet, so blender
+	never has to look for a free name itself. It does that one datablock at a
+	time, which gets slow with thousands of objects of the same name.
 
-		if me:
-#			me.calc_normals()
-			me.validate()
-			me.update(calc_edges=True)
+	Like blender, a name is split into its base and a trailing .NNN number, and
+	a taken name gets the lowest number not used with its base yet. An empty
+	name becomes default_name, the name blender gives unnamed datablocks
+	'''
+	def __init__(self, collection, default_name):
+		self.default_name = default_name
+		self.used = set(collection.keys())
+		self.numbers = {}			# base name -> numbers in use with it (0 for the bare base)
+		for name in self.used:
+			self.add_number(name)
+		self.next_number = {}		# base name -> lowest number that may still be free
 
+	'''
+	Returns name, or its base with the first free .001 style number
+	'''
+	def get(self, name):
+		# blender names are limited to 63 bytes
+		name = self.truncate(name, 63) or self.default_name
+		if name in self.used:
+			base = self.split_number(name)[0]
+			numbers = self.numbers.get(base, ())
+			number = self.next_number.get(base, 1)
+			while True:
+				digits = "{0:03d}".format(number)
+				# the base is shortened to leave room for the number
+				candidate = "{0}.{1}".format(self.truncate(base, 62 - len(digits)), digits)
+				if number not in numbers and candidate not in self.used:
+					break
+				number += 1
+			self.next_number[base] = number + 1
+			name = candidate
+		self.used.add(name)
+		self.add_number(name)
+		return name
+
+	def add_number(self, name):
+		base, number = self.split_number(name)
+		self.numbers.setdefault(base, set()).add(number)
 
-class AcSurf:
-	class AcSurfFlags:
-		def __init__(self, flags):
-			self.type = 0		# Surface Type: 0=Polygon, 1=closedLine, 2=Line
-			self.shaded = False
-			self.two_sided = False
-			i = int(flags,16)
+	'''
+	Splits 'Cube.001' into ('Cube', 1), names without a number get 0
+	'''
+	def split_number(self, name):
+		base, dot, digits = name.rpartition('.')
+		if dot and digits.isdigit():
+			return base, int(digits)
+		return name, 0
 
-			self.type = i & 0xF
-			i = i >> 4
-			if i&1:
-				self.shaded = True
-			if i&2:
-				self.two_sided = True
+	def truncate(self, name, max_bytes):
+		return name.encode('utf-8')[:max_bytes].decode('utf-8', 'ignore')
 
+class AcDeferredImages:
 	'''
-	Container class for surface definition within a parent object
+	Images whose files are loaded after the geometry has been imported. Until
+	then they are 1x1 placeholders, so the materials and faces can use them
+	already. A placeholder only turns into the real image in one go, so the
+	loading can be stopped at any time.
+
+	The images are kept by name, an undo or a file load while the textures are
+	loading would leave references to them dangling
 	'''
-	def __init__(self, flags, ac_file, import_config):
-		self.flags = self.AcSurfFlags(flags)			# surface flags
-		self.mat_index = 0				# default material
-		self.refs = []				# list of indexes into the parent objects defined vertexes with defined UV coordinates 
-		self.uv_refs = []
-		self.tokens =	{
-						'mat':	self.read_surf_material,
-						'refs':	self.read_surf_refs,
-						}
+	def __init__(self):
+		self.pending = []			# (name of the placeholder image, path of the file)
+		self.done = 0				# number of images loaded (or failed) so far
 
-		self.import_config = import_config
-		self.read_ac_surfaces(ac_file)
+	def add(self, path):
+		bl_image = bpy.data.images.new(bpy.path.basename(path), 1, 1)
+		self.pending.append((bl_image.name, path))
+		return bl_image
 
-	def read_ac_surfaces(self, ac_file):
-		surf_done=False
-		while not surf_done:
-			line = ac_file.readline()
-			if line=='':
+	'''
+	Loads images until time_budget seconds have gone by, returns True once all of them are done
+	'''
+	def load_slice(self, time_budget):
+		end = time.time() + time_budget
+		while self.done < len(self.pending):
+			image_name, path = self.pending[self.done]
+			self.done += 1
+			bl_image = bpy.data.images.get(image_name)
+			if bl_image == None:
+				# gone meanwhile (undo, new file, deleted by the user)
+				continue
+			try:
+				bl_image.source = 'FILE'
+				bl_image.filepath = path
+				bl_image.reload()
+				# reload() only lets go of the old buffers, asking for the size
+				# decodes the file now, instead of on the next redraw
+				bl_image.size[0]
+			except:
+				TRACE("Failed to load texture: {0}".format(path))
+			if time.time() >= end:
 				break
-			toks = line.split()
-			if len(toks)>0:
-				if toks[0] in self.tokens.keys():
-					surf_done = self.tokens[toks[0]](ac_file,toks)
-				else:
-					surf_done = True
-			
-	def read_surf_material(self, ac_file, tokens):
-		self.mat_index = int(tokens[1])
+		return self.done >= len(self.pending)
+
+# the files of the texture search roots by normalized root, kept for the whole
+# blender session: (lower case file name -> path, directory -> mtime)
+texture_root_index = {}
+
+class AcTextureFinder:
+	'''
+	Finds the files of textures. Each directory is listed once and every
+	lookup after that is a dictionary lookup, names match regardless of case
+	'''
+	def __init__(self, importdir, search_roots):
+		self.importdir = importdir
+		self.search_roots = search_roots	# directories searched with their subdirectories
+		self.listings = {}					# directory -> {file name and lower case file name: file name}
+		self.checked_roots = set()			# search roots known to be up to date in this import
+
+	'''
+	Returns the path of the file of tex_name, or None. The name is tried as it
+	is, relative to the .ac file, in the directory of the .ac file and then in
+	the search roots
+	'''
+	def find(self, tex_name):
+		base_name = bpy.path.basename(tex_name)
+		for path in [ tex_name,
+					os.path.join(self.importdir, tex_name),
+					os.path.join(self.importdir, base_name) ]:
+			found = self.find_file(path)
+			if found:
+				return found
+
+		# the first root a name is found in wins
+		for root in self.search_roots:
+			if root not in texture_root_index:
+				self.scan_root(root)
+			path = texture_root_index[root][0].get(base_name.lower())
+			if path is None and root not in self.checked_roots:
+				# the index may be from an earlier import, rescan the root if
+				# files have been added or removed since, once per import
+				self.checked_roots.add(root)
+				if self.root_changed(root):
+					self.scan_root(root)
+					path = texture_root_index[root][0].get(base_name.lower())
+			if path:
+				return path
+		return None
+
+	'''
+	Returns the path of the file at path (with the case of the name as it is on
+	disk), or None
+	'''
+	def find_file(self, path):
+		directory, name = os.path.split(os.path.abspath(path))
+		listing = self.listings.get(directory)
+		if listing is None:
+			listing = {}
+			try:
+				entries = sorted(os.listdir(directory))
+			except EnvironmentError:
+				entries = []
+			for entry in entries:
+				listing.setdefault(entry.lower(), entry)
+			# an exact match wins over one that only differs in case
+			for entry in entries:
+				listing[entry] = entry
+			self.listings[directory] = listing
+
+		entry = listing.get(name) or listing.get(name.lower())
+		if entry:
+			return os.path.join(directory, entry)
+		return None
+
+	'''
+	Indexes the files of a search root and its subdirectories by their lower
+	case name into texture_root_index, along with the modification times of
+	the directories
+	'''
+	def scan_root(self, root):
+		TRACE("Scanning texture path {0}".format(root))
+		index = {}
+		mtimes = {}
+		for directory, dirs, files in os.walk(root):
+			mtimes[directory] = self.get_mtime(directory)
+			dirs.sort()
+			for name in sorted(files):
+				index.setdefault(name.lower(), os.path.join(directory, name))
+		texture_root_index[root] = (index, mtimes)
+		self.checked_roots.add(root)
+
+	'''
+	Returns True if a directory of the indexed root has been modified since it
+	was scanned (which includes new subdirectories)
+	'''
+	def root_changed(self, root):
+		mtimes = texture_root_index[root][1]
+		if not mtimes:
+			# wasn't there at all
+			return os.path.isdir(root)
+		for directory, mtime in mtimes.items():
+			if self.get_mtime(directory) != mtime:
+				return True
 		return False
-	
-	def read_surf_refs(self, ac_file, tokens):
-		num_refs = int(tokens[1])
-		for n in range(num_refs):
-			line = ac_file.readline()
-			line = line.strip().split()
-		
-			self.refs.append(int(line[0]))
-			self.uv_refs.append([float(x) for x in line[1:3]])
-		return True
-
-	def get_faces(self):
-		# convert refs and surface type to faces
-		surf_faces = []
-		# make sure it's a face type polygon and that there's the right number of vertices
-		if self.flags.type == 0 and len(self.refs) > 2:
-			surf_faces = self.refs
-		return surf_faces
-
-	def get_edges(self):
-		# convert refs and surface type to edges
-		surf_edges = []
-		if self.flags.type != 0:
-			# poly-line
-			mainline = []
-			mainline.extend(self.refs)
-			surf_edges.append(mainline)
-
-			if self.flags.type == 1:
-				# closed poly-line
-				surf_edges.append([self.refs[len(self.refs)-1], self.refs[0]])
-		return surf_edges
+
+	def get_mtime(self, path):
+		try:
+			return os.path.getmtime(path)
+		except EnvironmentError:
+			return None
 
 class ImportConf:
 	def __init__(
@@ -552,6 +894,13 @@ class ImportConf:
 			use_amb_as_mircol,
 			display_transparency,
 			display_textured_solid,
+			scan_only,
+			object_filter,
+			use_shared_meshes,
+			force_validate,
+			texture_paths,
+			use_file_identity,
+			defer_textures,
 			):
 		# Stuff that needs to be available to the working classes (ha!)
 		self.operator = operator
@@ -564,11 +913,157 @@ class ImportConf:
 		self.use_amb_as_mircol = use_amb_as_mircol
 		self.display_transparency = display_transparency
 		self.display_textured_solid = display_textured_solid
+		self.scan_only = scan_only
+		# name or path patterns of the subtrees to import, all objects if empty
+		self.object_filter = [pattern.strip() for pattern in object_filter.split(',') if pattern.strip()]
+		self.use_shared_meshes = use_shared_meshes
+		self.force_validate = force_validate
+		# number of surface problems of each kind repaired while reading
+		self.repairs = {}
+		# meshes created so far, by the content key of the objects they were built for
+		self.shared_meshes = {}
+		# objects created so far, in creation order (parents first)
+		self.new_objects = []
+		# free names for the new objects and meshes (set up once the file has been read)
+		self.object_names = None
+		self.mesh_names = None
+		# blender materials that can be used again, by their ac3d_key (read on first use)
+		self.material_registry = None
+		self.use_file_identity = use_file_identity
+		# blender images by the keys of their files (read on first use)
+		self.image_registry = None
+		# blender image textures by image and texrep (read on first use)
+		self.texture_registry = None
+		# images to load once the geometry is in, None to load them straight away
+		self.deferred_images = None
+		if defer_textures:
+			self.deferred_images = AcDeferredImages()
+
+		# global_matrix split into a (transposed) rotation and a translation, so it
+		# can be applied to a whole vertex array at once. Both stay None for an
+		# identity matrix, in which case no transform is done at all
+		self.global_rotation = None
+		self.global_translation = None
+		if global_matrix is not None:
+			matrix = numpy.array([list(row) for row in global_matrix], dtype=numpy.float64)
+			if not numpy.array_equal(matrix, numpy.identity(len(matrix))):
+				self.global_rotation = matrix[:3, :3].T.copy()
+				self.global_translation = numpy.zeros(3)
+				if matrix.shape[1] > 3:
+					self.global_translation = matrix[:3, 3].copy()
 
 		# used to determine relative file paths
 		self.importdir = os.path.dirname(filepath)
 		self.ac_name = os.path.split(filepath)[1]
+
+		# relative search paths start from the .ac file, $FG_ROOT and the like are expanded
+		search_roots = []
+		for path in texture_paths.split(';'):
+			path = os.path.expandvars(os.path.expanduser(path.strip()))
+			if path:
+				search_roots.append(os.path.normpath(os.path.join(self.importdir, path)))
+		self.texture_finder = AcTextureFinder(self.importdir, search_roots)
 		TRACE("Importing {0}".format(self.ac_name))
+
+	'''
+	Returns the blender materials made by earlier imports by their ac3d_key,
+	the materials are only gone through once per import
+	'''
+	def get_material_registry(self):
+		if self.material_registry is None:
+			self.material_registry = {}
+			for bl_mat in bpy.data.materials:
+				registry_key = bl_mat.get('ac3d_key')
+				if not registry_key:
+					continue
+				if bl_mat.get('ac3d_state') != self.get_material_state(bl_mat):
+					# edited since it was imported, it no longer is what the key says
+					del bl_mat['ac3d_key']
+					continue
+				self.material_registry.setdefault(registry_key, bl_mat)
+		return self.material_registry
+
+	'''
+	Hash of the properties of bl_mat the importer sets, which the registry key
+	stands for (colours, shading, transparency and the texture image)
+	'''
+	def get_material_state(self, bl_mat):
+		values = list(bl_mat.diffuse_color) + list(bl_mat.specular_color) + list(bl_mat.mirror_color)
+		values += [bl_mat.ambient, bl_mat.emit, bl_mat.alpha, bl_mat.specular_hardness]
+		state = [int(round(value * 1000)) for value in values]
+		state += [bl_mat.use_transparency, bl_mat.transparency_method, bl_mat.use_face_texture_alpha]
+
+		tex_slot = bl_mat.texture_slots[0]
+		if tex_slot and tex_slot.texture:
+			bl_image = getattr(tex_slot.texture, 'image', None)
+			state += [tex_slot.use_map_alpha, tex_slot.texture.repeat_x, tex_slot.texture.repeat_y,
+					bl_image.name if bl_image else None]
+		return hashlib.sha1(repr(state).encode('utf-8')).hexdigest()
+
+	'''
+	Key of an image texture: its image and texrep. Textures without an image
+	(the file wasn't found) go by the texture name
+	'''
+	def get_texture_key(self, bl_image, tex_name, texrep):
+		if bl_image == None:
+			return (None, tex_name, texrep[0], texrep[1])
+		return (bl_image.name, None, texrep[0], texrep[1])
+
+	'''
+	Returns the blender image textures by their key, the textures in blender
+	are gone through once per import
+	'''
+	def get_texture_registry(self):
+		if self.texture_registry is None:
+			self.texture_registry = {}
+			for bl_tex in bpy.data.textures:
+				bl_image = getattr(bl_tex, 'image', None)
+				if bl_tex.type == 'IMAGE' and bl_image != None:
+					tex_key = self.get_texture_key(bl_image, bl_tex.name, (bl_tex.repeat_x, bl_tex.repeat_y))
+					self.texture_registry.setdefault(tex_key, bl_tex)
+		return self.texture_registry
+
+	'''
+	Keys an image file is known by: its normalized absolute path and, if asked
+	for, its device and inode (which also catch links and other mounts)
+	'''
+	def get_image_keys(self, path):
+		keys = [os.path.normcase(os.path.realpath(os.path.abspath(path)))]
+		if self.use_file_identity:
+			try:
+				stat = os.stat(path)
+				keys.append((stat.st_dev, stat.st_ino))
+			except EnvironmentError:
+				pass
+		return keys
+
+	'''
+	Returns the blender image already loaded from the file at path, or None.
+	The images in blender are gone through once per import
+	'''
+	def find_image(self, path):
+		if self.image_registry is None:
+			self.image_registry = {}
+			for bl_image in bpy.data.images:
+				if bl_image.filepath:
+					self.register_image(bl_image, bpy.path.abspath(bl_image.filepath))
+		for key in self.get_image_keys(path):
+			bl_image = self.image_registry.get(key)
+			if bl_image != None:
+				return bl_image
+		return None
+
+	def register_image(self, bl_image, path):
+		for key in self.get_image_keys(path):
+			self.image_registry.setdefault(key, bl_image)
+
+	'''
+	Apply the global matrix to an (N,3) array of vertices with one batched multiply
+	'''
+	def transform_vertices(self, verts):
+		if self.global_rotation is None:
+			return verts
+		return numpy.dot(verts, self.global_rotation) + self.global_translation
 	
 class ImportAC3D:
 	def __init__(
@@ -585,6 +1080,18 @@ class ImportAC3D:
 			use_amb_as_mircol=False,
 			display_transparency=True,
 			display_textured_solid=False,
+			use_mmap=True,
+			scan_only=False,
+			object_filter="",
+			use_cache=False,
+			cache_dir="",
+			cache_size=1024,
+			use_shared_meshes=True,
+			force_validate=False,
+			merge_by_material=False,
+			texture_paths="",
+			use_file_identity=False,
+			defer_textures=False,
 			):
 
 		self.import_config = ImportConf(
@@ -599,20 +1106,26 @@ class ImportAC3D:
 										use_amb_as_mircol,
 										display_transparency,
 										display_textured_solid,
+										scan_only,
+										object_filter,
+										use_shared_meshes,
+										force_validate,
+										texture_paths,
+										use_file_identity,
+										defer_textures,
 										)
 
 
-		self.tokens = 	{
-						'MATERIAL':		self.read_material,
-						'OBJECT':		self.read_object,
-						}
 		self.oblist = []
 		self.matlist = []
+		self.read_failed = False	# set once an error has been reported while reading the file
+		# images still to load, for the operator to work through
+		self.deferred_images = self.import_config.deferred_images
 
 		operator.report({'INFO'}, "Attempting import: {file}".format(file=filepath))
 
 		# Check to make sure we're working with a valid AC3D file
-		ac_file = open(filepath, 'r')
+		ac_file = self.open_ac_file(filepath, use_mmap)
 		self.header = ac_file.readline().strip()
 		if len(self.header) != 5:
 			operator.report({'ERROR'},"Invalid file header length: {0}".format(self.header))
@@ -627,11 +1140,35 @@ class ImportAC3D:
 			ac_file.close()
 			return None
 
-		self.read_ac_file(ac_file)
+		cache = None
+		cache_entry = None
+		if use_cache and not scan_only:
+			cache = AcCache(cache_dir, cache_size * 1024 * 1024)
+			# the cached vertices have the axis conversion applied already
+			cache_key = cache.make_key(filepath, repr(self.import_config.global_rotation) + repr(self.import_config.global_translation))
+			cache_entry = cache.load(cache_key)
+
+		if cache_entry:
+			TRACE("Using cached parse of {0}".format(filepath))
+			self.read_cache(*cache_entry)
+		else:
+			self.read_ac_file(ac_file)
+			self.report_repairs()
+			# a filtered or failed parse is missing some of the file, and a
+			# file without objects has nothing worth caching
+			if cache and self.oblist and not self.import_config.object_filter and not self.read_failed:
+				self.write_cache(cache, cache_key)
 
 		ac_file.close()
 
-		self.create_blender_data()
+		if scan_only:
+			self.report_index()
+			return None
+
+		if merge_by_material:
+			self.create_merged_data()
+		else:
+			self.create_blender_data()
 
 		# Display as either textured solid (transparency only works in one direction) or as textureless solids (transparency works)
 		for bl_screen in bpy.data.screens:
@@ -643,60 +1180,313 @@ class ImportAC3D:
 
 		return None
 
+	'''
+	Opens the .ac file for reading, through a memory map if requested and possible
+	'''
+	def open_ac_file(self, filepath, use_mmap):
+		if use_mmap:
+			try:
+				return AcMmapReader(filepath)
+			except (ValueError, EnvironmentError) as e:
+				# eg. empty files can't be mapped
+				TRACE("Unable to memory-map {0} ({1}), reading as text".format(filepath, e))
+		return AcFileReader(filepath)
+
+	'''
+	Stores the materials and objects read from the file in the parse cache. The
+	object tree is flattened (parents first) and the arrays of all objects are
+	joined into one array each
+	'''
+	def write_cache(self, cache, cache_key):
+		materials = [{
+					'name': mat.name, 'rgb': mat.rgb, 'amb': mat.amb, 'emis': mat.emis,
+					'spec': mat.spec, 'shi': mat.shi, 'trans': mat.trans,
+					} for mat in self.matlist]
+
+		objects = []
+		arrays = dict((name, []) for name in AcObj.CACHED_ARRAYS)
+		sizes = dict((name, 0) for name in AcObj.CACHED_ARRAYS)
+		stack = [(obj, -1) for obj in reversed(self.oblist)]
+		while stack:
+			obj, parent_index = stack.pop()
+			meta = obj.get_cache_meta()
+			meta['parent'] = parent_index
+			meta['slices'] = {}
+			for name in AcObj.CACHED_ARRAYS:
+				array = getattr(obj, name)
+				arrays[name].append(array)
+				meta['slices'][name] = (sizes[name], sizes[name] + len(array))
+				sizes[name] += len(array)
+			stack.extend((child, len(objects)) for child in reversed(obj.children))
+			objects.append(meta)
+
+		for name in AcObj.CACHED_ARRAYS:
+			arrays[name] = numpy.concatenate(arrays[name])
+
+		cache.store(cache_key, {'materials': materials, 'objects': objects}, arrays)
+
+	'''
+	Rebuilds the materials and objects from a parse cache entry, the object
+	arrays are slices of the memory-mapped cache arrays
+	'''
+	def read_cache(self, meta, arrays):
+		for mat in meta['materials']:
+			self.matlist.append(AcMat(mat['name'], mat['rgb'], mat['amb'], mat['emis'],
+									mat['spec'], mat['shi'], mat['trans'], self.import_config))
+
+		objects = []
+		for obj_meta in meta['objects']:
+			parent = None
+			if obj_meta['parent'] >= 0:
+				parent = objects[obj_meta['parent']]
+			obj = AcObj(obj_meta['type'], self.import_config, parent)
+			obj.set_cache_meta(obj_meta)
+			for name in AcObj.CACHED_ARRAYS:
+				start, end = obj_meta['slices'][name]
+				setattr(obj, name, arrays[name][start:end])
+
+			if parent:
+				parent.children.append(obj)
+			else:
+				self.oblist.append(obj)
+			objects.append(obj)
+
+	'''
+	Reports the object index built by a scan only pass
+	'''
+	def report_index(self):
+		obj_count = 0
+		vert_count = 0
+		surf_count = 0
+		stack = [(obj, "") for obj in reversed(self.oblist)]
+		while stack:
+			obj, str_pre = stack.pop()
+			obj_count += 1
+			vert_count += obj.num_vert
+			surf_count += obj.num_surf
+			TRACE("{0}+-{1} '{2}' @{3} numvert {4} {5} numsurf {6} {7} kids {8}".format(
+					str_pre, obj.type, obj.name, obj.offset,
+					obj.num_vert, obj.vert_range, obj.num_surf, obj.surf_range, obj.num_kids))
+			stack.extend((child, str_pre + "  ") for child in reversed(obj.children))
+
+		self.import_config.operator.report({'INFO'}, "{0}: {1} objects, {2} vertices, {3} surfaces".format(
+					self.import_config.ac_name, obj_count, vert_count, surf_count))
+
 	'''
 	Simplifies the reporting of errors to the user
 	'''
 	def report_error(self, message):
+		# whatever was read after this can't be trusted to be the whole file
+		self.read_failed = True
 		TRACE(message)
 		self.import_config.operator.report({'ERROR'},message)
 
 	'''
-	read our validated .ac file
+	Tells the user about the surface problems repaired while reading the file
+	'''
+	def report_repairs(self):
+		repairs = self.import_config.repairs
+		if repairs:
+			self.import_config.operator.report({'INFO'}, "Repaired geometry: {0}".format(
+					", ".join("{0} {1}".format(repairs[problem], problem) for problem in sorted(repairs))))
+
+	'''
+	read our validated .ac file, building the materials and the object tree from the parser events
 	'''
 	def read_ac_file(self, ac_file):
-		reader = csv.reader(ac_file, delimiter=' ', skipinitialspace=True)
+		# the objects the current one is nested in, the current one last
+		objects = []
+		obj = None
 		try:
-			for row in reader:
-				# See if this is a valid token and pass the file handle and the current line to our function
-				if row[0] in self.tokens.keys():
-					self.tokens[row[0]](ac_file,row)
-				else:
-					self.report_error("invalid token: {tok} ({ln})".format(tok=row[0], ln=row))				
-		except csv.Error(e):
-			self.report_error('AC3D import error, line %d: %s' % (reader.line_num, e))
-
-	'''
-	Take the passed in line and interpret as a .ac material
-	'''
-	def read_material(self, ac_file, line):
-
-		# MATERIAL %s rgb %f %f %f  amb %f %f %f  emis %f %f %f  spec %f %f %f  shi %d  trans %f
-		self.matlist.append(AcMat(line[1],
-						[float(x) for x in line[3:6]],
-						[float(x) for x in line[7:10]],
-						[float(x) for x in line[11:14]],
-						[float(x) for x in line[15:18]],
-						float(line[19]), # it should be int but float seems to be used sometimes
-						float(line[21]),
-						self.import_config,
-						))
+			for event, data in parse_events(ac_file):
+				if event == PROPERTY:
+					handler = AcObj.tokens.get(data[0])
+					if handler:
+						handler(obj, data)
+				elif event == VERTICES:
+					obj.read_vertices(data)
+				elif event == SURFACES:
+					obj.read_surfaces(data)
+				elif event == BEGIN_OBJECT:
+					ob_type, offset, depth = data
+					obj = AcObj(ob_type, self.import_config, obj, offset)
+					if obj.ac_parent:
+						obj.ac_parent.children.append(obj)
+					else:
+						self.oblist.append(obj)
+					objects.append(obj)
+				elif event == END_OBJECT:
+					objects.pop()
+					obj = objects[-1] if objects else None
+				elif event == MATERIAL:
+					self.read_material(data)
+				elif event == INVALID_TOKEN:
+					self.report_error("invalid token: {tok} (line {ln})".format(tok=data[0], ln=ac_file.line_no))
+		except AcParseError as e:
+			self.report_error('AC3D import error, line %d: %s' % (e.line_no, e))
+		except (ValueError, IndexError) as e:
+			self.report_error('AC3D import error, line %d: %s' % (ac_file.line_no, e))
 
 	'''
-	Read the Object definition (including child objects)
+	Take the material read by the parser and interpret as a .ac material
 	'''
-	def read_object(self, ac_file, line):
-		# OBJECT %s
-		self.oblist.append(AcObj(line[1], ac_file, self.import_config))
+	def read_material(self, mat):
+		self.matlist.append(AcMat(mat['name'],
+						mat['rgb'],
+						mat['amb'],
+						mat['emis'],
+						mat['spec'],
+						mat['shi'],
+						mat['trans'],
+						self.import_config,
+						))
 
 	'''
 	Reads the data imported from the file and creates blender data
 	'''
 	def create_blender_data(self):
+		self.reserve_names()
 
-		# go through the list of objects
-		bUseLink = True
-		for obj in self.oblist:
-			if self.oblist.index(obj) == len(self.oblist)-1:
-				bUseLink = False
-			obj.create_blender_object(self.matlist, "", bUseLink)
+		# go through the object tree, parents first. The stack holds the
+		# objects still to create with their TRACE prefix and whether more
+		# objects follow on their level
+		stack = []
+		for no, obj in enumerate(reversed(self.oblist)):
+			stack.append((obj, "", no != 0))
+
+		while stack:
+			obj, str_pre, bLevelLinked = stack.pop()
+			obj.create_blender_object(self.matlist, str_pre)
+
+			if bLevelLinked:
+				str_pre_new = str_pre + "| "
+			else:
+				str_pre_new = str_pre + "  "
+			for no, child in enumerate(reversed(obj.children)):
+				stack.append((child, str_pre_new, no != 0))
+
+		self.link_blender_objects()
+
+	'''
+	Sets up the tables of free object and mesh names from what is in blender already
+	'''
+	def new_name_tables(self):
+		self.import_config.object_names = AcNames(bpy.data.objects, "Object")
+		self.import_config.mesh_names = AcNames(bpy.data.meshes, "Mesh")
+
+	'''
+	Works out the names of all the objects of the file before any of them is
+	created, taking the names that are in use already into account
+	'''
+	def reserve_names(self):
+		self.new_name_tables()
+
+		# in the order the objects are created, so the suffixes count up the same way
+		stack = list(reversed(self.oblist))
+		while stack:
+			obj = stack.pop()
+			if obj.type in ('group', 'poly') and obj.is_selected():
+				obj.bl_name = self.import_config.object_names.get(obj.name)
+			stack.extend(reversed(obj.children))
+
+	'''
+	Creates one mesh object for each combination of material, texture and
+	texrep in the file instead of the object tree. The vertices of all poly
+	objects are moved to where their objects would have put them, and the name
+	of every object becomes a vertex group of the merged mesh
+	'''
+	def create_merged_data(self):
+		# the surfaces, vertices and vertex groups collected for each
+		# (material index, texture, texrep), in the order they first appear
+		pieces = {}
+		keys = []
+
+		# go through the object tree, parents first, working out where each
+		# object is. The world object is never created, so it doesn't count
+		stack = [(obj, mathutils.Matrix()) for obj in reversed(self.oblist)]
+		while stack:
+			obj, matrix = stack.pop()
+			if obj.type != 'world':
+				matrix = matrix * mathutils.Matrix.Translation(obj.location) * obj.rotation.to_4x4()
+			for child in reversed(obj.children):
+				stack.append((child, matrix))
+
+			if obj.type != 'poly' or not obj.is_selected() or not len(obj.vertices):
+				continue
+
+			world = numpy.array([list(row) for row in matrix], dtype=numpy.float64)
+			verts = numpy.dot(obj.vertices, world[:3, :3].T) + world[:3, 3]
+			surf_counts = numpy.diff(obj.surf_offsets)
+			used_mats, first_surf = numpy.unique(obj.surf_mats, return_index=True)
+			for mat_index in used_mats[numpy.argsort(first_surf)]:
+				key = (int(mat_index), obj.tex_name, tuple(obj.texrep))
+				if key not in pieces:
+					pieces[key] = {'obj': obj, 'num_vert': 0, 'vertex_groups': [], 'vertices': [],
+									'refs': [], 'uvs': [], 'counts': [], 'flags': []}
+					keys.append(key)
+				piece = pieces[key]
+
+				# the surfaces of the material and only the vertices they use
+				is_used = obj.surf_mats == mat_index
+				is_used_ref = numpy.repeat(is_used, surf_counts)
+				used_verts, refs = numpy.unique(obj.surf_refs[is_used_ref], return_inverse=True)
+				piece['vertex_groups'].append((obj.name, piece['num_vert'], len(used_verts)))
+				piece['vertices'].append(verts[used_verts])
+				piece['refs'].append(refs + piece['num_vert'])
+				piece['uvs'].append(obj.surf_uvs[is_used_ref])
+				piece['counts'].append(surf_counts[is_used])
+				piece['flags'].append(obj.surf_flags[is_used])
+				piece['num_vert'] += len(used_verts)
+
+		# none of the objects of the file is created, so only the merged ones take names
+		self.new_name_tables()
+		for key in keys:
+			piece = pieces[key]
+			merged = self.new_merged_object(piece['obj'], key[0])
+			merged.bl_name = self.import_config.object_names.get(merged.name)
+			surf_counts = numpy.concatenate(piece['counts'])
+			merged.vertices = numpy.concatenate(piece['vertices'])
+			merged.surf_offsets = numpy.zeros(len(surf_counts) + 1, dtype=numpy.int32)
+			numpy.cumsum(surf_counts, out=merged.surf_offsets[1:])
+			merged.surf_refs = numpy.concatenate(piece['refs']).astype(numpy.int32)
+			merged.surf_uvs = numpy.concatenate(piece['uvs'])
+			merged.surf_flags = numpy.concatenate(piece['flags'])
+			merged.surf_mats = numpy.zeros(len(surf_counts), dtype=numpy.int32) + key[0]
+			merged.num_vert = len(merged.vertices)
+			merged.num_surf = len(surf_counts)
+			merged.vertex_group_list = piece['vertex_groups']
+			merged.create_blender_object(self.matlist, "")
+
+		self.link_blender_objects()
+
+	'''
+	Returns a poly object to merge the surfaces of material mat_index of obj,
+	and of the objects like it, into
+	'''
+	def new_merged_object(self, obj, mat_index):
+		merged = AcObj('poly', self.import_config)
+		merged.name = self.matlist[mat_index].name
+		if len(obj.tex_name):
+			merged.name = "{0} ({1})".format(merged.name, os.path.basename(obj.tex_name))
+		merged.tex_name = obj.tex_name
+		merged.texrep = list(obj.texrep)
+		merged.crease = obj.crease
+		# picked already, the filter doesn't apply to the merged objects
+		merged.selected = True
+		return merged
+
+	'''
+	Links the objects created by create_blender_data to the scene in one go,
+	the last one becomes the active object and the scene is updated once
+	'''
+	def link_blender_objects(self):
+		new_objects = self.import_config.new_objects
+		if not new_objects:
+			return
+		scene = self.import_config.context.scene
+		link = scene.objects.link
+		for bl_obj in new_objects:
+			link(bl_obj)
+		scene.objects.active = new_objects[-1]
+		scene.update()
 
@@ -0,0 +1,335 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+
+import numpy
+
+if __package__:
+	from .reader_ac3d import AcFileReader, AcMmapReader, AcParseError, decode_floats
+else:
+	# imported by a tool with this directory on sys.path, outside blender
+	from reader_ac3d import AcFileReader, AcMmapReader, AcParseError, decode_floats
+
+'''
+Streaming parser for .ac files, the importer is built on top of it.
+
+parse_events walks a file and yields (event, data) pairs without building an
+object tree, so files far too big to keep around as Python objects can be
+scanned, filtered and summarised:
+
+ - MATERIAL		dictionary with name, rgb, amb, emis, spec, shi and trans
+ - BEGIN_OBJECT	(type, byte offset of the OBJECT line, depth)
+ - PROPERTY		the tokens of an object line (name, loc, rot, texture, ...).
+				For data the second token is the data string itself
+ - VERTICES		AcVertexBlock of a numvert block
+ - SURFACES		AcSurfaceBlock of a numsurf block
+ - END_OBJECT	type of the object, sent once all its kids have been sent
+ - INVALID_TOKEN	the tokens of a line that doesn't belong where it was found
+
+The numvert/numsurf blocks are handed out before they are read. Calling read()
+on the block decodes it, anything that wasn't read by the time the next event
+is asked for gets skipped without decoding.
+
+Nothing in here depends on blender, tools can import this module (and
+reader_ac3d) straight from this directory without loading the add-on.
+'''
+
+MATERIAL = 'material'
+BEGIN_OBJECT = 'begin_object'
+PROPERTY = 'property'
+VERTICES = 'vertices'
+SURFACES = 'surfaces'
+END_OBJECT = 'end_object'
+INVALID_TOKEN = 'invalid_token'
+
+# SURF flag bits
+SURF_TYPE_MASK = 0x0F		# Surface Type: 0=Polygon, 1=closedLine, 2=Line
+SURF_SHADED = 0x10
+SURF_TWOSIDED = 0x20
+
+# object lines that are handed out as they are
+OBJECT_PROPERTIES = set(['name', 'data', 'texture', 'texrep', 'texoff', 'rot', 'loc',
+						'url', 'crease', 'subdiv', 'hidden', 'locked', 'folded'])
+
+class AcBlock:
+	'''
+	Base class of the numvert/numsurf blocks handed out by parse_events
+	'''
+	def __init__(self, ac_file, count):
+		self.ac_file = ac_file
+		self.count = count				# numvert/numsurf count
+		self.line_no = ac_file.line_no	# line number of the numvert/numsurf line
+		self.start = ac_file.tell()		# byte offset of the first line of the block
+		self.end = None					# byte offset just past the block, once it's been read or skipped
+
+	def skip(self):
+		if self.end is None:
+			self.skip_block()
+			self.end = self.ac_file.tell()
+
+	def read(self):
+		if self.end is not None:
+			raise AcParseError("block has been read already", self.line_no)
+		data = self.read_block()
+		self.end = self.ac_file.tell()
+		return data
+
+class AcVertexBlock(AcBlock):
+	'''
+	A numvert block, read() returns the vertices as a (count, N) float64 array
+	(N is 3 unless the file has extra columns)
+	'''
+	def read_block(self):
+		if self.count == 0:
+			return numpy.zeros((0, 3))
+		return self.ac_file.read_floats(self.count, 3)
+
+	def skip_block(self):
+		self.ac_file.skip_lines(self.count)
+
+class AcSurfaceBlock(AcBlock):
+	'''
+	A numsurf block, read() returns the flags, material indices and ref counts
+	of the surfaces and an (N,3) float64 array with the index and UV of all refs
+	'''
+	def read_block(self):
+		flags, mats, counts, ref_block = self.ac_file.read_surfaces(self.count)
+
+		ref_count = int(counts.sum())
+		try:
+			refs = decode_floats(ref_block)
+		except ValueError:
+			refs = []
+		if len(refs) != ref_count * 3:
+			# some refs have no UV co-ordinates, pad them out line by line
+			refs = numpy.zeros((ref_count, 3))
+			try:
+				for n, line in enumerate(ref_block.splitlines()):
+					values = [float(x) for x in line.split()[:3]]
+					refs[n, :len(values)] = values
+			except (ValueError, IndexError):
+				raise AcParseError("invalid refs in numsurf {0}".format(self.count), self.line_no)
+		return flags, mats, counts, refs.reshape(ref_count, 3)
+
+	def skip_block(self):
+		self.ac_file.skip_surfaces(self.count)
+
+'''
+Checks the surfaces read from a numsurf block against the num_vert vertices of
+the object and repairs them in array form, so the mesh built from them needs no
+further validation:
+
+ - surfaces referring to a vertex that doesn't exist are dropped
+ - a vertex repeated straight after itself is removed (for polygons and closed
+   lines this includes the last and first ref)
+ - polygons with less than 3 refs and lines with less than 2 are dropped
+ - polygons using a vertex more than once are dropped
+ - polygons using the same vertices as an earlier one are dropped
+
+Returns the repaired flags, mats, counts and refs, and a dictionary with the
+number of problems of each kind that were found
+'''
+def repair_surfaces(num_vert, flags, mats, counts, refs):
+	problems = {}
+	counts = numpy.asarray(counts, dtype=numpy.int64)
+
+	# vertex index of every ref and the surface it belongs to
+	verts = refs[:, 0]
+	surf_ids = numpy.repeat(numpy.arange(len(counts)), counts)
+	bad = numpy.zeros(len(counts), dtype=bool)
+	bad[surf_ids[(verts < 0) | (verts >= num_vert)]] = True
+	if bad.any():
+		problems['out of range refs'] = int(bad.sum())
+		refs = refs[numpy.repeat(~bad, counts)]
+		flags, mats, counts = flags[~bad], mats[~bad], counts[~bad]
+
+	# refs repeating the one before them
+	surf_types = flags & SURF_TYPE_MASK
+	verts = refs[:, 0].astype(numpy.int64)
+	starts = numpy.cumsum(counts) - counts
+	has_refs = counts > 0
+	lasts = (starts + counts - 1)[has_refs]
+	is_open = surf_types[has_refs] == 2
+	# the last ref of a closed surface is followed by the first one, the last
+	# ref of an open line is followed by nothing
+	following = numpy.arange(1, len(verts) + 1)
+	following[lasts] = starts[has_refs]
+	repeated = verts == verts[following]
+	repeated[lasts[is_open]] = False
+	if repeated.any():
+		problems['repeated refs'] = int(repeated.sum())
+		surf_ids = numpy.repeat(numpy.arange(len(counts)), counts)
+		counts = counts - numpy.bincount(surf_ids[repeated], minlength=len(counts))
+		refs = refs[~repeated]
+		verts = verts[~repeated]
+
+	# too few refs left
+	is_polygon = surf_types == 0
+	bad = counts < numpy.where(is_polygon, 3, 2)
+	if bad.any():
+		problems['degenerate surfaces'] = int(bad.sum())
+		keep_refs = numpy.repeat(~bad, counts)
+		refs = refs[keep_refs]
+		verts = verts[keep_refs]
+		flags, mats, counts, is_polygon = flags[~bad], mats[~bad], counts[~bad], is_polygon[~bad]
+
+	# polygons using a vertex twice, found by sorting the refs by surface and
+	# vertex. The refs of each surface stay where they were in the sorted order
+	starts = numpy.cumsum(counts) - counts
+	surf_ids = numpy.repeat(numpy.arange(len(counts)), counts)
+	order = numpy.lexsort((verts, surf_ids))
+	sorted_verts = verts[order]
+	twice = (surf_ids[1:] == surf_ids[:-1]) & (sorted_verts[1:] == sorted_verts[:-1])
+	bad = numpy.zeros(len(counts), dtype=bool)
+	bad[surf_ids[1:][twice]] = True
+	bad &= is_polygon
+	if bad.any():
+		problems['polygons using a vertex twice'] = int(bad.sum())
+
+	# polygons using the same vertices as an earlier one, the sorted vertices
+	# of the polygons of one size are compared row by row
+	duplicate = numpy.zeros(len(counts), dtype=bool)
+	candidates = is_polygon & ~bad
+	for count in numpy.unique(counts[candidates]):
+		same_size = numpy.flatnonzero(candidates & (counts == count))
+		if len(same_size) < 2:
+			continue
+		rows = sorted_verts[starts[same_size, None] + numpy.arange(count)]
+		# lexsort is stable, so the first of equal rows stays in front of the others
+		row_order = numpy.lexsort(rows.T[::-1])
+		rows = rows[row_order]
+		same = (rows[1:] == rows[:-1]).all(axis=1)
+		duplicate[same_size[row_order[1:][same]]] = True
+	if duplicate.any():
+		problems['duplicate polygons'] = int(duplicate.sum())
+		bad |= duplicate
+
+	if bad.any():
+		refs = refs[numpy.repeat(~bad, counts)]
+		flags, mats, counts = flags[~bad], mats[~bad], counts[~bad]
+
+	return flags, mats, counts, refs, problems
+
+'''
+Turns the tokens of a MATERIAL line into a dictionary
+'''
+def parse_material(toks):
+	# MATERIAL %s rgb %f %f %f  amb %f %f %f  emis %f %f %f  spec %f %f %f  shi %d  trans %f
+	return {
+			'name': toks[1],
+			'rgb': [float(x) for x in toks[3:6]],
+			'amb': [float(x) for x in toks[7:10]],
+			'emis': [float(x) for x in toks[11:14]],
+			'spec': [float(x) for x in toks[15:18]],
+			'shi': float(toks[19]), # it should be int but float seems to be used sometimes
+			'trans': float(toks[21]),
+			}
+
+'''
+Yields the events of an .ac file, ac_file is a reader that has been moved past
+the header line already. The object tree is followed with an explicit stack of
+the objects still waiting for kids, so deep hierarchies don't recurse
+'''
+def parse_events(ac_file):
+	# [type, kids still to come] of the objects the current one is nested in
+	pending = []
+	while True:
+		toks = ac_file.read_tokens()
+		if not toks:
+			break
+
+		if toks[0] == 'OBJECT':
+			ob_type = toks[1]
+			yield BEGIN_OBJECT, (ob_type, ac_file.line_start, len(pending))
+			num_kids = 0
+			while True:
+				toks = ac_file.read_tokens()
+				if not toks:
+					break
+				keyword = toks[0]
+				if keyword in OBJECT_PROPERTIES:
+					if keyword == 'data':
+						line = ac_file.readline()
+						toks = [keyword, line[:int(toks[1])]]
+					yield PROPERTY, toks
+				elif keyword == 'numvert':
+					block = AcVertexBlock(ac_file, int(toks[1]))
+					yield VERTICES, block
+					block.skip()
+				elif keyword == 'numsurf':
+					block = AcSurfaceBlock(ac_file, int(toks[1]))
+					yield SURFACES, block
+					block.skip()
+				elif keyword == 'kids':
+					num_kids = int(toks[1])
+					yield PROPERTY, toks
+					break
+				else:
+					# ends the object, as if it had no kids
+					yield INVALID_TOKEN, toks
+					break
+
+			if num_kids:
+				pending.append([ob_type, num_kids])
+				continue
+			yield END_OBJECT, ob_type
+
+			# close the parents whose last kid this was
+			while pending:
+				pending[-1][1] -= 1
+				if pending[-1][1] > 0:
+					break
+				yield END_OBJECT, pending.pop()[0]
+
+		elif pending:
+			# a parent is still waiting for an OBJECT
+			yield INVALID_TOKEN, toks
+
+		elif toks[0] == 'MATERIAL':
+			yield MATERIAL, parse_material(toks)
+
+		else:
+			yield INVALID_TOKEN, toks
+
+	# close whatever a truncated file left open
+	while pending:
+		yield END_OBJECT, pending.pop()[0]
+
+'''
+Yields the events of the .ac file at filepath, see parse_events. Raises an
+AcParseError if the file doesn't start with an AC3D header
+'''
+def parse_file(filepath, use_mmap=True):
+	ac_file = None
+	if use_mmap:
+		try:
+			ac_file = AcMmapReader(filepath)
+		except (ValueError, EnvironmentError):
+			# eg. empty files can't be mapped
+			pass
+	if ac_file is None:
+		ac_file = AcFileReader(filepath)
+
+	try:
+		header = ac_file.readline().strip()
+		if len(header) != 5 or header[:4] != 'AC3D':
+			raise AcParseError("invalid file header: {0}".format(header), 1)
+		for event in parse_events(ac_file):
+			yield event
+	finally:
+		ac_file.close()
@@ -0,0 +1,527 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+
+import os
+import mmap
+from itertools import islice
+
+import numpy
+
+'''
+Line readers for .ac files, used by the importer.
+
+Both readers hand out the keyword lines of the file already split into tokens
+(read_tokens) and whole blocks of lines (read_lines) for the numeric
+numvert/refs blocks, so those can be decoded in one go with decode_floats.
+
+ - AcFileReader reads the file through a normal buffered file object
+ - AcMmapReader memory-maps the file and works on the raw bytes. Blocks are
+   located by scanning the map for newlines with NumPy and are handed out as a
+   single bytes slice, no Python string is made for the individual lines
+
+Both keep track of the line number (line_no) and the byte offsets in the file
+(tell, line_start) and can skip numvert/numsurf blocks without decoding them
+(skip_lines, skip_surfaces), which is what the scan only import uses to build
+its object index.
+
+Nothing in here depends on blender.
+'''
+
+'''
+Split a line into its tokens, quoted strings (which may hold spaces) are
+returned as one token without their quotes
+'''
+def split_line(line):
+	if '"' not in line:
+		return line.split()
+	parts = line.split('"')
+	if len(parts) == 3:
+		# the usual single name
+		toks = parts[0].split()
+		toks.append(parts[1])
+		toks.extend(parts[2].split())
+		return toks
+	toks = []
+	for n, part in enumerate(parts):
+		if n % 2:
+			toks.append(part)
+		else:
+			toks.extend(part.split())
+	return toks
+
+class AcParseError(ValueError):
+	'''
+	An error in the .ac file, raised with the number of the offending line
+	'''
+	def __init__(self, message, line_no):
+		ValueError.__init__(self, message)
+		self.line_no = line_no
+
+'''
+Decode a block of whitespace separated numbers (str or bytes) into a flat float64 array
+'''
+def decode_floats(block):
+	try:
+		return numpy.fromstring(block, dtype=numpy.float64, sep=' ')
+	except ValueError:
+		# let the slow path report what it choked on
+		return numpy.array(block.split(), dtype=numpy.float64)
+
+class AcReader:
+	'''
+	Base class for the readers, everything in here only needs readline and
+	read_lines, except find_surfaces which needs get_bytes and size
+	'''
+	# below this many lines (or surfaces) it's cheaper to go through them one by one
+	SCAN_THRESHOLD = 16
+
+	def join_lines(self, blocks):
+		return b''.join(blocks)
+
+	'''
+	Returns the tokens of the next line that isn't blank, an empty list at the end of the file
+	'''
+	def read_tokens(self):
+		while True:
+			line = self.readline()
+			if line == '':
+				return []
+			toks = split_line(line)
+			if toks:
+				return toks
+
+	'''
+	Raises an AcParseError for the line_no-th line of the file (the last line read by default)
+	'''
+	def error(self, message, line_no=None):
+		if line_no is None:
+			line_no = self.line_no
+		raise AcParseError(message, line_no)
+
+	'''
+	Reads the next count lines of (at least) width numbers each and returns them
+	as a (count, N) float64 array. Raises an AcParseError for the first bad line
+	'''
+	def read_floats(self, count, width):
+		first_line = self.line_no + 1
+		block = self.read_lines(count)
+		try:
+			values = decode_floats(block)
+		except ValueError:
+			values = None
+		if values is None or len(values) < count * width or len(values) % count:
+			bad_line = self.find_bad_line(block, first_line, width)
+			if bad_line is None:
+				self.error("expected {0} lines of numbers".format(count))
+			self.error("expected {0} numbers".format(width), bad_line)
+		return values.reshape(count, -1)
+
+	'''
+	Returns the line number of the first line in block (which starts on line
+	first_line) that doesn't hold at least width numbers, None if there isn't one
+	'''
+	def find_bad_line(self, block, first_line, width):
+		for n, line in enumerate(block.splitlines()):
+			try:
+				values = [float(x) for x in line.split()]
+			except ValueError:
+				return first_line + n
+			if len(values) < width:
+				return first_line + n
+		return None
+
+	'''
+	skips the next count lines
+	'''
+	def skip_lines(self, count):
+		self.read_lines(count)
+
+	'''
+	skips a numsurf block, nothing but the SURF/mat/refs lines gets decoded
+	'''
+	def skip_surfaces(self, surf_count):
+		self.read_surfaces(surf_count)
+
+	'''
+	Read the SURF/mat/refs lines of a numsurf block. Returns the flags, material
+	indices and ref counts of the surfaces as arrays, plus one block holding
+	the ref lines of all surfaces
+	'''
+	def read_surfaces(self, surf_count):
+		flags = []
+		mats = []
+		counts = []
+		ref_blocks = []
+
+		for n in range(surf_count):
+			toks = self.read_tokens()
+			if not toks:
+				break
+			if toks[0] != 'SURF':
+				continue
+
+			surf_flags = int(toks[1], 16)
+			mat_index = 0
+			num_refs = 0
+			while True:
+				stoks = self.read_tokens()
+				if not stoks:
+					break
+				if stoks[0] == 'mat':
+					mat_index = int(stoks[1])
+				elif stoks[0] == 'refs':
+					num_refs = int(stoks[1])
+					ref_blocks.append(self.read_lines(num_refs))
+					break
+				else:
+					break
+
+			flags.append(surf_flags)
+			mats.append(mat_index)
+			counts.append(num_refs)
+
+		return (numpy.array(flags, dtype=numpy.uint8),
+				numpy.array(mats, dtype=numpy.int32),
+				numpy.array(counts, dtype=numpy.int32),
+				self.join_lines(ref_blocks))
+
+	'''
+	Finds and checks the lines of a numsurf block starting at byte offset pos,
+	working on the raw bytes the reader's get_bytes returns. Returns them as
+	AcSurfLines, or None if the block doesn't follow the usual layout. With
+	check_counts the refs counts are also compared to the ref lines found
+	'''
+	def find_surfaces(self, pos, surf_count, check_counts=True):
+		size = self.size
+		# a surface usually takes 100-150 bytes, better guess high than scan twice
+		chunk = surf_count * 160
+		while True:
+			end = min(pos + chunk, size)
+			block = self.get_bytes(pos, end)
+			ends = numpy.flatnonzero(block == 10)
+			if end == size and (len(block) == 0 or block[-1] != 10):
+				# last line of the file without a newline
+				ends = numpy.append(ends, len(block))
+			starts = numpy.concatenate(([0], ends[:-1] + 1))
+			first = block[numpy.minimum(starts, len(block) - 1)]
+
+			surf_lines = numpy.flatnonzero(first == ord('S'))
+			if len(surf_lines) >= surf_count:
+				last_surf = surf_lines[surf_count - 1]
+				refs_lines = numpy.flatnonzero(first == ord('r'))
+				k = numpy.searchsorted(refs_lines, last_surf)
+				if k < len(refs_lines):
+					last_refs = refs_lines[k]
+					toks = block[starts[last_refs]:ends[last_refs]].tobytes().split()
+					if len(toks) != 2 or toks[0] != b'refs' or not toks[1].isdigit():
+						return None
+					line_count = last_refs + 1 + int(toks[1])
+					if line_count <= len(starts):
+						break
+			if end == size:
+				# truncated file
+				return None
+			chunk *= 2
+
+		starts = starts[:line_count]
+		ends = ends[:line_count]
+		first = first[:line_count]
+		block = block[:ends[-1] + 1]
+
+		is_surf = first == ord('S')
+		is_mat = first == ord('m')
+		is_refs = first == ord('r')
+		is_ref = ~(is_surf | is_mat | is_refs)
+
+		# every surface is SURF, an optional mat and refs, followed by the ref lines
+		surf_lines = numpy.flatnonzero(is_surf)
+		if len(surf_lines) != surf_count or surf_lines[0] != 0:
+			return None
+		has_mat = first[surf_lines + 1] == ord('m')
+		refs_lines = surf_lines + 1 + has_mat
+		if (first[refs_lines] != ord('r')).any() or is_mat.sum() != has_mat.sum() or is_refs.sum() != surf_count:
+			return None
+		ref_first = first[is_ref]
+		if not ((ref_first >= ord('0')) & (ref_first <= ord('9'))).all():
+			return None
+
+		next_surf = numpy.append(surf_lines[1:], line_count)
+		counts = (next_surf - refs_lines - 1).astype(numpy.int32)
+
+		if check_counts:
+			try:
+				declared = decode_floats(self.cut_lines(block, starts, ends, refs_lines, 4))
+			except ValueError:
+				# leave the bad refs line to the line by line reader, it knows its number
+				return None
+			if len(declared) != surf_count or (declared != counts).any():
+				return None
+
+		return AcSurfLines(block, starts, ends, surf_lines, has_mat, numpy.flatnonzero(is_ref), counts)
+
+	'''
+	returns the given lines of block, each from offset on (including the newline), as one bytes object
+	'''
+	def cut_lines(self, block, starts, ends, lines, offset):
+		if offset == 0:
+			# whole lines, mask them byte by byte
+			keep = numpy.zeros(len(starts), dtype=bool)
+			keep[lines] = True
+			mask = numpy.repeat(keep, ends - starts + 1)[:len(block)]
+			return block[mask].tobytes()
+
+		# short pieces of a few lines, gather them by index
+		first = starts[lines] + offset
+		lengths = ends[lines] + 1 - first
+		index = numpy.repeat(first - numpy.cumsum(lengths) + lengths, lengths)
+		index += numpy.arange(len(index))
+		return block[index[index < len(block)]].tobytes()
+
+class AcFileReader(AcReader):
+	'''
+	Reads a .ac file through a buffered file object
+	'''
+	def __init__(self, filepath):
+		self.ac_file = open(filepath, 'rb')
+		self.size = os.fstat(self.ac_file.fileno()).st_size
+		self.pos = 0				# byte offset of the next line
+		self.line_start = 0			# byte offset of the last line read
+		self.line_no = 0			# number of the last line read
+
+	def close(self):
+		self.ac_file.close()
+
+	def tell(self):
+		return self.pos
+
+	def readline(self):
+		line = self.ac_file.readline()
+		self.line_start = self.pos
+		self.pos += len(line)
+		if line:
+			self.line_no += 1
+		return line.decode('utf-8', 'replace')
+
+	# same as AcReader.read_tokens, without the call to readline for every line
+	def read_tokens(self):
+		ac_file = self.ac_file
+		while True:
+			line = ac_file.readline()
+			if not line:
+				self.line_start = self.pos
+				return []
+			self.line_start = self.pos
+			self.pos += len(line)
+			self.line_no += 1
+			toks = split_line(line.decode('utf-8', 'replace'))
+			if toks:
+				return toks
+
+	'''
+	returns the next count lines as one bytes object
+	'''
+	def read_lines(self, count):
+		lines = list(islice(self.ac_file, count))
+		block = b''.join(lines)
+		self.pos += len(block)
+		self.line_no += len(lines)
+		return block
+
+	'''
+	returns the bytes from pos to end as a uint8 array, without moving on in the file
+	'''
+	def get_bytes(self, pos, end):
+		self.ac_file.seek(pos)
+		data = self.ac_file.read(end - pos)
+		self.ac_file.seek(self.pos)
+		return numpy.frombuffer(data, dtype=numpy.uint8)
+
+	'''
+	skips a numsurf block, large ones are located in chunks read from the file
+	like AcMmapReader does, so none of their lines is tokenized
+	'''
+	def skip_surfaces(self, surf_count):
+		lines = None
+		if surf_count > self.SCAN_THRESHOLD:
+			lines = self.find_surfaces(self.pos, surf_count, False)
+		if lines is None:
+			AcReader.skip_surfaces(self, surf_count)
+		else:
+			self.pos += len(lines.block)
+			self.ac_file.seek(self.pos)
+			self.line_no += len(lines.starts)
+
+class AcSurfLines:
+	'''
+	The lines of a numsurf block found in a memory map
+	'''
+	def __init__(self, block, starts, ends, surf_lines, has_mat, ref_lines, counts):
+		self.block = block				# bytes of the block, up to and including its last newline
+		self.starts = starts			# offset of each line in block
+		self.ends = ends				# offset of the newline of each line
+		self.surf_lines = surf_lines	# line number of each SURF line
+		self.has_mat = has_mat			# whether each surface has a mat line
+		self.ref_lines = ref_lines		# line numbers of all ref lines
+		self.counts = counts			# ref count of each surface
+
+class AcMmapReader(AcReader):
+	'''
+	Reads a .ac file through a read-only memory map
+	'''
+	def __init__(self, filepath):
+		self.ac_file = open(filepath, 'rb')
+		try:
+			self.mm = mmap.mmap(self.ac_file.fileno(), 0, access=mmap.ACCESS_READ)
+		except:
+			self.ac_file.close()
+			raise
+		self.buf = numpy.frombuffer(self.mm, dtype=numpy.uint8)
+		self.size = len(self.buf)
+		self.line_start = 0			# byte offset of the last line read
+		self.line_no = 0			# number of the last line read
+
+	def close(self):
+		# the map can't be closed while the array still refers to it
+		self.buf = None
+		self.mm.close()
+		self.ac_file.close()
+
+	def tell(self):
+		return self.mm.tell()
+
+	def readline(self):
+		self.line_start = self.mm.tell()
+		line = self.mm.readline()
+		if line:
+			self.line_no += 1
+		return line.decode('utf-8', 'replace')
+
+	# same as AcReader.read_tokens, without the call to readline for every line
+	def read_tokens(self):
+		mm = self.mm
+		while True:
+			self.line_start = mm.tell()
+			line = mm.readline()
+			if not line:
+				return []
+			self.line_no += 1
+			toks = split_line(line.decode('utf-8', 'replace'))
+			if toks:
+				return toks
+
+	'''
+	returns the next count lines as one bytes object
+	'''
+	def read_lines(self, count):
+		start = self.mm.tell()
+		end = self.find_line_end(start, count)
+		self.mm.seek(end)
+		self.line_no += count
+		return self.mm[start:end]
+
+	def skip_lines(self, count):
+		self.mm.seek(self.find_line_end(self.mm.tell(), count))
+		self.line_no += count
+
+	def get_bytes(self, pos, end):
+		return self.buf[pos:end]
+
+	'''
+	returns the offset just past the count-th newline from pos (or the end of the file)
+	'''
+	def find_line_end(self, pos, count):
+		size = len(self.buf)
+		if count <= self.SCAN_THRESHOLD:
+			for n in range(count):
+				pos = self.mm.find(b'\n', pos)
+				if pos < 0:
+					return size
+				pos += 1
+			return pos
+
+		chunk = count * 64
+		while pos < size:
+			newlines = numpy.flatnonzero(self.buf[pos:pos+chunk] == 10)
+			if len(newlines) >= count:
+				return pos + int(newlines[count-1]) + 1
+			count -= len(newlines)
+			pos += chunk
+			chunk *= 2
+		return size
+
+	'''
+	Decodes the whole numsurf block straight from the map: the lines are told
+	apart by their first byte, the mat/refs numbers and all ref lines are cut out
+	with masks. Anything that doesn't follow the usual SURF, [mat], refs layout
+	is handed to the line by line reader instead, as are small blocks
+	'''
+	def read_surfaces(self, surf_count):
+		surfs = None
+		if surf_count > self.SCAN_THRESHOLD:
+			lines = self.find_surfaces(self.mm.tell(), surf_count)
+			if lines is not None:
+				surfs = self.decode_surfaces(lines)
+		if surfs is None:
+			return AcReader.read_surfaces(self, surf_count)
+		self.mm.seek(self.mm.tell() + len(lines.block))
+		self.line_no += len(lines.starts)
+		return surfs
+
+	def skip_surfaces(self, surf_count):
+		lines = None
+		if surf_count > self.SCAN_THRESHOLD:
+			lines = self.find_surfaces(self.mm.tell(), surf_count, False)
+		if lines is None:
+			AcReader.skip_surfaces(self, surf_count)
+		else:
+			self.mm.seek(self.mm.tell() + len(lines.block))
+			self.line_no += len(lines.starts)
+
+	'''
+	Decodes the lines found by find_surfaces, returns None if they can't be decoded
+	'''
+	def decode_surfaces(self, lines):
+		block = lines.block
+		starts = lines.starts
+		ends = lines.ends
+		surf_count = len(lines.surf_lines)
+
+		mats = numpy.zeros(surf_count, dtype=numpy.int32)
+		if lines.has_mat.any():
+			try:
+				mat_values = decode_floats(self.cut_lines(block, starts, ends, lines.surf_lines[lines.has_mat] + 1, 3))
+			except ValueError:
+				return None
+			if len(mat_values) != lines.has_mat.sum():
+				return None
+			mats[lines.has_mat] = mat_values
+
+		try:
+			flags = [int(x, 16) for x in self.cut_lines(block, starts, ends, lines.surf_lines, 4).split()]
+		except ValueError:
+			return None
+		if len(flags) != surf_count:
+			return None
+
+		ref_block = self.cut_lines(block, starts, ends, lines.ref_lines, 0)
+
+		return (numpy.array(flags, dtype=numpy.uint8),
+				mats,
+				lines.counts,
+				ref_block)
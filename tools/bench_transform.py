@@ -0,0 +1,194 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+'''
+Checks and times the batched import axis conversion against the old per-vertex
+one on the vertices of a real .ac file.
+
+	python tools/bench_transform.py model.ac [repeat]
+	blender -b -P tools/bench_transform.py -- model.ac [repeat]
+
+The old importer did global_matrix * Vector(v) for every vertex. Inside
+blender that is what's timed here, outside of it mathutils isn't available and
+the same per-vertex multiply is done in plain Python instead.
+
+Inside blender the batched side is the importer's own
+ImportConf.transform_vertices. Outside of it the importer can't be loaded, so
+a copy of what that method does is timed instead: one dot product with the
+transposed 3x3 rotation plus the translation, skipped for the identity. Only
+the run inside blender checks the shipped code.
+
+Both the import matrix (-Z forward, Y up) and one with a translation are
+checked, the results have to match to float tolerance (mathutils works in
+single precision). Exits with status 1 if they don't.
+'''
+
+import os
+import sys
+import time
+
+import numpy
+
+repo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(repo_dir, 'io_scene_ac3d'))
+from parse_ac3d import parse_file, VERTICES
+
+try:
+	from mathutils import Matrix, Vector
+except ImportError:
+	Matrix = None
+
+import_ac3d = None
+if Matrix is not None:
+	# inside blender, so the importer itself can be loaded
+	sys.path.insert(0, repo_dir)
+	from io_scene_ac3d import import_ac3d
+
+# axis_conversion(from_forward='-Z', from_up='Y').to_4x4(), the import default
+IMPORT_MATRIX = [
+		[1.0, 0.0, 0.0, 0.0],
+		[0.0, 0.0, -1.0, 0.0],
+		[0.0, 1.0, 0.0, 0.0],
+		[0.0, 0.0, 0.0, 1.0],
+		]
+
+# a rotation about Z with a translation, to check the translation as well
+SHIFTED_MATRIX = [
+		[0.0, -1.0, 0.0, 10.0],
+		[1.0, 0.0, 0.0, -2.5],
+		[0.0, 0.0, 1.0, 0.125],
+		[0.0, 0.0, 0.0, 1.0],
+		]
+
+'''
+Returns the vertex arrays of all objects of the .ac file
+'''
+def read_vertex_arrays(filepath):
+	arrays = []
+	for event, data in parse_file(filepath):
+		if event == VERTICES:
+			arrays.append(data.read()[:, :3])
+	return arrays
+
+'''
+The old way: one matrix * vector per vertex
+'''
+def transform_per_vertex(matrix, arrays):
+	results = []
+	if Matrix is not None:
+		bl_matrix = Matrix(matrix)
+		for verts in arrays:
+			results.append([tuple(bl_matrix * Vector(v)) for v in verts.tolist()])
+	else:
+		(m00, m01, m02, m03), (m10, m11, m12, m13), (m20, m21, m22, m23) = matrix[:3]
+		for verts in arrays:
+			results.append([(m00*x + m01*y + m02*z + m03,
+							m10*x + m11*y + m12*z + m13,
+							m20*x + m21*y + m22*z + m23) for x, y, z in verts.tolist()])
+	return results
+
+'''
+Returns the batched transform of an (N,3) vertex array by matrix: the
+importer's ImportConf.transform_vertices inside blender, a copy of it outside
+'''
+def get_batched_transform(matrix, filepath):
+	if import_ac3d is not None:
+		import_config = import_ac3d.ImportConf(
+				operator=None,
+				context=None,
+				filepath=filepath,
+				global_matrix=Matrix(matrix),
+				use_transparency=True,
+				transparency_method='Z_TRANSPARENCY',
+				use_auto_smooth=True,
+				use_emis_as_mircol=True,
+				use_amb_as_mircol=False,
+				display_transparency=True,
+				display_textured_solid=False,
+				scan_only=False,
+				object_filter="",
+				use_shared_meshes=False,
+				force_validate=False,
+				texture_paths="",
+				use_file_identity=False,
+				defer_textures=False,
+				)
+		return import_config.transform_vertices
+
+	matrix = numpy.array(matrix, dtype=numpy.float64)
+	if numpy.array_equal(matrix, numpy.identity(4)):
+		return lambda verts: verts
+	rotation = matrix[:3, :3].T.copy()
+	translation = matrix[:3, 3].copy()
+	return lambda verts: numpy.dot(verts, rotation) + translation
+
+'''
+The new way, one batched transform per vertex array
+'''
+def transform_batched(transform, arrays):
+	return [transform(verts) for verts in arrays]
+
+def best_time(function, repeat):
+	best = None
+	for n in range(repeat):
+		start = time.time()
+		result = function()
+		elapsed = time.time() - start
+		if best is None or elapsed < best:
+			best = elapsed
+	return best, result
+
+def main(argv):
+	if not argv:
+		print(__doc__)
+		return 2
+	filepath = argv[0]
+	repeat = int(argv[1]) if len(argv) > 1 else 3
+
+	arrays = read_vertex_arrays(filepath)
+	vert_count = sum(len(verts) for verts in arrays)
+	print("{0}: {1} objects with vertices, {2} vertices ({3})".format(
+			filepath, len(arrays), vert_count,
+			"mathutils against ImportConf.transform_vertices" if import_ac3d is not None else
+			"plain Python per-vertex against a copy of ImportConf.transform_vertices"))
+
+	ok = True
+	for label, matrix in (("import matrix", IMPORT_MATRIX), ("shifted matrix", SHIFTED_MATRIX)):
+		old_time, old = best_time(lambda: transform_per_vertex(matrix, arrays), repeat)
+		transform = get_batched_transform(matrix, filepath)
+		new_time, new = best_time(lambda: transform_batched(transform, arrays), repeat)
+
+		max_error = 0.0
+		for old_verts, new_verts in zip(old, new):
+			if len(old_verts):
+				old_verts = numpy.array(old_verts, dtype=numpy.float64)
+				scale = max(1.0, float(numpy.abs(old_verts).max()))
+				max_error = max(max_error, float(numpy.abs(old_verts - new_verts).max()) / scale)
+		matches = max_error <= 1e-6
+		ok = ok and matches
+
+		print("{0}: per-vertex {1:.4f}s, batched {2:.4f}s, {3:.1f}x faster, max relative difference {4:.2e} ({5})".format(
+				label, old_time, new_time, old_time / max(new_time, 1e-9), max_error, "ok" if matches else "MISMATCH"))
+	return 0 if ok else 1
+
+if __name__ == '__main__':
+	# blender passes its own arguments before '--'
+	argv = sys.argv[1:]
+	if '--' in argv:
+		argv = argv[argv.index('--') + 1:]
+	sys.exit(main(argv))